@@ -1,5 +1,5 @@
 import asyncpg
-from typing import Optional, Dict, List, Any, Union
+from typing import Optional, Dict, List, Union
 import logging
 from datetime import datetime, date
 
@@ -81,14 +81,57 @@ async def add_student(conn: asyncpg.Connection, user_id: int, group_id: Optional
     await conn.execute(query, user_id, group_id)
 
 
+async def register_student(
+    conn: asyncpg.Connection,
+    telegram_id: int,
+    username: Optional[str],
+    first_name: str,
+    last_name: str,
+    group_id: int,
+) -> int:
+    """
+    Завершает регистрацию студента одним выражением: users (роль student, имя — только
+    если было пустым), снятие с преподавателей, students с выбранной группой.
+    Возвращает user_id.
+    """
+    query = """
+    WITH u AS (
+        INSERT INTO users (telegram_id, username, first_name, last_name, role, approved)
+        VALUES ($1, $2, $3, $4, 'student', FALSE)
+        ON CONFLICT (telegram_id) DO UPDATE SET
+            role = 'student',
+            first_name = CASE WHEN users.first_name = '' OR users.last_name = ''
+                              THEN EXCLUDED.first_name ELSE users.first_name END,
+            last_name  = CASE WHEN users.first_name = '' OR users.last_name = ''
+                              THEN EXCLUDED.last_name ELSE users.last_name END
+        RETURNING user_id
+    ),
+    del_t AS (
+        DELETE FROM teachers WHERE teacher_id IN (SELECT user_id FROM u)
+    ),
+    ins_s AS (
+        INSERT INTO students (student_id, group_id)
+        SELECT user_id, $5 FROM u
+        ON CONFLICT (student_id) DO UPDATE SET
+            group_id = EXCLUDED.group_id,
+            pending_group_id = NULL,
+            group_change_requested_at = NULL
+    )
+    SELECT user_id FROM u;
+    """
+    return await conn.fetchval(query, telegram_id, username, first_name, last_name, group_id)
+
+
 async def add_teacher(conn: asyncpg.Connection, user_id: int):
     query = "INSERT INTO teachers (teacher_id) VALUES ($1) ON CONFLICT (teacher_id) DO NOTHING"
     await conn.execute(query, user_id)
 
 
-async def get_user(conn: asyncpg.Connection, telegram_id: int) -> Optional[Dict]:
-    query = """
-    SELECT u.*,
+# Общий SELECT для get_user/get_user_by_db_id/get_users — только поля, которые читает бот.
+# Тексты запросов собираются один раз при импорте: asyncpg кэширует подготовленные
+# выражения на соединении по тексту, так что повторные вызовы не парсятся заново.
+_USER_SELECT = """
+    SELECT u.user_id, u.telegram_id, u.first_name, u.last_name, u.role, u.approved,
            s.group_id,
            g.name  AS group_name,
            s.pending_group_id,
@@ -101,30 +144,25 @@ async def get_user(conn: asyncpg.Connection, telegram_id: int) -> Optional[Dict]
     LEFT JOIN students s ON u.user_id = s.student_id
     LEFT JOIN groups g ON s.group_id = g.group_id
     LEFT JOIN groups pg ON s.pending_group_id = pg.group_id
-    WHERE u.telegram_id = $1
-    """
-    result = await conn.fetchrow(query, telegram_id)
+"""
+_USER_BY_TELEGRAM_ID_SQL = _USER_SELECT + "    WHERE u.telegram_id = $1\n"
+_USER_BY_DB_ID_SQL = _USER_SELECT + "    WHERE u.user_id = $1\n"
+# фильтры get_users: NULL = «не фильтровать», текст запроса один на все комбинации
+_USERS_FILTERED_SQL = _USER_SELECT + """
+    WHERE ($1::bool IS NULL OR u.approved = $1)
+      AND ($2::text IS NULL OR u.role = $2)
+      AND ($3::int  IS NULL OR s.group_id = $3)
+    ORDER BY u.last_name, u.first_name;
+"""
+
+
+async def get_user(conn: asyncpg.Connection, telegram_id: int) -> Optional[Dict]:
+    result = await conn.fetchrow(_USER_BY_TELEGRAM_ID_SQL, telegram_id)
     return _record_to_dict(result)
 
 
 async def get_user_by_db_id(conn: asyncpg.Connection, user_id: int) -> Optional[Dict]:
-    query = """
-    SELECT u.*,
-           s.group_id,
-           g.name  AS group_name,
-           s.pending_group_id,
-           pg.name AS pending_group_name,
-           s.group_change_requested_at,
-           u.pending_first_name,
-           u.pending_last_name,
-           u.name_change_requested_at
-    FROM users u
-    LEFT JOIN students s ON u.user_id = s.student_id
-    LEFT JOIN groups g ON s.group_id = g.group_id
-    LEFT JOIN groups pg ON s.pending_group_id = pg.group_id
-    WHERE u.user_id = $1
-    """
-    result = await conn.fetchrow(query, user_id)
+    result = await conn.fetchrow(_USER_BY_DB_ID_SQL, user_id)
     return _record_to_dict(result)
 
 
@@ -172,19 +210,18 @@ async def get_pending_group_changes(conn: asyncpg.Connection) -> List[Dict]:
 
 
 async def approve_group_change(conn: asyncpg.Connection, student_user_id: int) -> bool:
-    async with conn.transaction():
-        pid = await conn.fetchval(
-            "SELECT pending_group_id FROM students WHERE student_id = $1 AND pending_group_id IS NOT NULL FOR UPDATE",
-            student_user_id,
-        )
-        if pid is None:
-            return False
-        status = await conn.execute(
-            "UPDATE students SET group_id = $1, pending_group_id = NULL, group_change_requested_at = NULL WHERE student_id = $2;",
-            pid,
-            student_user_id,
-        )
-        return status == 'UPDATE 1'
+    # одно атомарное UPDATE: без отдельного SELECT ... FOR UPDATE и явной транзакции
+    query = """
+    UPDATE students
+       SET group_id = pending_group_id,
+           pending_group_id = NULL,
+           group_change_requested_at = NULL
+     WHERE student_id = $1
+       AND pending_group_id IS NOT NULL
+ RETURNING student_id;
+    """
+    result = await conn.fetchval(query, student_user_id)
+    return result is not None
 
 
 async def reject_group_change(conn: asyncpg.Connection, student_user_id: int) -> bool:
@@ -229,28 +266,19 @@ async def get_pending_name_changes(conn: asyncpg.Connection) -> List[Dict]:
 
 
 async def approve_name_change(conn: asyncpg.Connection, user_id: int) -> bool:
-    async with conn.transaction():
-        pending_names = await conn.fetchrow(
-            "SELECT pending_first_name, pending_last_name FROM users WHERE user_id = $1 AND pending_first_name IS NOT NULL FOR UPDATE",
-            user_id,
-        )
-        if not pending_names:
-            return False
-        status = await conn.execute(
-            """
-            UPDATE users
-               SET first_name = $1,
-                   last_name  = $2,
-                   pending_first_name = NULL,
-                   pending_last_name  = NULL,
-                   name_change_requested_at = NULL
-             WHERE user_id = $3;
-            """,
-            pending_names['pending_first_name'],
-            pending_names['pending_last_name'],
-            user_id,
-        )
-        return status == 'UPDATE 1'
+    query = """
+    UPDATE users
+       SET first_name = pending_first_name,
+           last_name  = pending_last_name,
+           pending_first_name = NULL,
+           pending_last_name  = NULL,
+           name_change_requested_at = NULL
+     WHERE user_id = $1
+       AND pending_first_name IS NOT NULL
+ RETURNING user_id;
+    """
+    result = await conn.fetchval(query, user_id)
+    return result is not None
 
 
 async def reject_name_change(conn: asyncpg.Connection, user_id: int) -> bool:
@@ -275,34 +303,7 @@ async def update_user_name(conn: asyncpg.Connection, user_id: int, first_name: s
 
 async def get_users(conn: asyncpg.Connection, approved: Optional[bool] = None, role: Optional[str] = None,
                     group_id: Optional[int] = None) -> List[Dict]:
-    base_query = """
-    SELECT u.*,
-           s.group_id,
-           g.name  AS group_name,
-           s.pending_group_id,
-           pg.name AS pending_group_name,
-           s.group_change_requested_at,
-           u.pending_first_name,
-           u.pending_last_name,
-           u.name_change_requested_at
-      FROM users u
- LEFT JOIN students s ON u.user_id = s.student_id
- LEFT JOIN groups g ON s.group_id = g.group_id
- LEFT JOIN groups pg ON s.pending_group_id = pg.group_id
-    """
-    conditions, params, idx = [], [], 1
-    if approved is not None:
-        conditions.append(f"u.approved = ${idx}"); params.append(approved); idx += 1
-    if role is not None:
-        conditions.append(f"u.role = ${idx}"); params.append(role); idx += 1
-    if group_id is not None:
-        conditions.append(f"s.group_id = ${idx}"); params.append(group_id); idx += 1
-    if conditions:
-        query = f"{base_query} WHERE {' AND '.join(conditions)}"
-    else:
-        query = base_query
-    query += " ORDER BY u.last_name, u.first_name;"
-    return _records_to_list_dicts(await conn.fetch(query, *params))
+    return _records_to_list_dicts(await conn.fetch(_USERS_FILTERED_SQL, approved, role, group_id))
 
 
 async def set_user_approved(conn: asyncpg.Connection, user_id: int, status: bool) -> Optional[Dict]:
@@ -315,30 +316,44 @@ async def set_user_role(conn: asyncpg.Connection, user_id: int, role: str) -> Op
     allowed = ('student', 'teacher', 'pending')
     if role not in allowed:
         raise ValueError(f"Bad role: {role}")
-    async with conn.transaction():
-        res = await conn.fetchrow(
-            "UPDATE users SET role = $1 WHERE user_id = $2 RETURNING user_id, role;",
-            role, user_id
-        )
-        if not res:
-            return None
-        if role == 'student':
-            await conn.execute("DELETE FROM teachers WHERE teacher_id = $1", user_id)
-            await conn.execute("INSERT INTO students (student_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
-        elif role == 'teacher':
-            await conn.execute("DELETE FROM students WHERE student_id = $1", user_id)
-            await conn.execute("INSERT INTO teachers (teacher_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
-        else:
-            await conn.execute("DELETE FROM students WHERE student_id = $1", user_id)
-            await conn.execute("DELETE FROM teachers WHERE teacher_id = $1", user_id)
+    # одно выражение с CTE — атомарно само по себе, один round-trip вместо 3 запросов в транзакции;
+    # вставки идут от upd, так что для несуществующего пользователя ничего не меняется
+    query = """
+    WITH upd AS (
+        UPDATE users SET role = $1 WHERE user_id = $2 RETURNING user_id, role
+    ),
+    del_s AS (
+        DELETE FROM students WHERE student_id = $2 AND $1::text <> 'student'
+    ),
+    del_t AS (
+        DELETE FROM teachers WHERE teacher_id = $2 AND $1::text <> 'teacher'
+    ),
+    ins_s AS (
+        INSERT INTO students (student_id)
+        SELECT user_id FROM upd WHERE $1::text = 'student'
+        ON CONFLICT DO NOTHING
+    ),
+    ins_t AS (
+        INSERT INTO teachers (teacher_id)
+        SELECT user_id FROM upd WHERE $1::text = 'teacher'
+        ON CONFLICT DO NOTHING
+    )
+    SELECT user_id, role FROM upd;
+    """
+    res = await conn.fetchrow(query, role, user_id)
     return _record_to_dict(res)
 
 
 async def get_teachers_ids(db_pool: asyncpg.Pool) -> List[int]:
-    query = "SELECT u.telegram_id FROM users u JOIN teachers t ON u.user_id = t.teacher_id WHERE u.approved = TRUE;"
-    async with db_pool.acquire() as conn:
-        results = await conn.fetch(query)
-    return [r['telegram_id'] for r in results]
+    # массив собирает Postgres — asyncpg сразу декодирует его в list[int], без Record на строку
+    query = """
+    SELECT COALESCE(array_agg(u.telegram_id), '{}')
+      FROM users u
+      JOIN teachers t ON u.user_id = t.teacher_id
+     WHERE u.approved = TRUE;
+    """
+    # один запрос — шорткат пула сам берёт и возвращает соединение
+    return await db_pool.fetchval(query)
 
 
 # --------------------------- assignments & submissions ---------------------------
@@ -503,7 +518,7 @@ async def get_questions(
       True  -> только с ответом;
       False -> только без ответа.
     """
-    base = """
+    query = """
         SELECT
             q.question_id, q.student_id, q.group_id, q.question_text, q.asked_at,
             q.answer_text, q.answered_by, q.answered_at,
@@ -516,17 +531,12 @@ async def get_questions(
         JOIN users u       ON u.user_id = q.student_id
         LEFT JOIN groups g ON g.group_id = q.group_id
         LEFT JOIN users ab ON ab.user_id = q.answered_by
+        WHERE $1::bool IS NULL
+           OR ($1 AND q.answer_text IS NOT NULL)
+           OR (NOT $1 AND q.answer_text IS NULL)
+        ORDER BY q.asked_at DESC
     """
-    where = []
-    params: List[Any] = []
-    if answered is True:
-        where.append("q.answer_text IS NOT NULL")
-    elif answered is False:
-        where.append("q.answer_text IS NULL")
-    if where:
-        base += " WHERE " + " AND ".join(where)
-    base += " ORDER BY q.asked_at DESC"
-    rows = await conn.fetch(base, *params)
+    rows = await conn.fetch(query, answered)
     return _records_to_list_dicts(rows)
 
 
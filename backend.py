@@ -1,43 +1,86 @@
 import os
 import asyncio
+import atexit
+import contextlib
 import logging
+import logging.handlers
+import queue
 import hmac
 import hashlib
+import secrets
+import signal
+import time
 import urllib.parse
 import uuid
-import mimetypes
-import json
+from collections import OrderedDict
 from datetime import datetime, date
 from typing import Any, Dict, List, Optional, Tuple
 
+import aiofiles
 import asyncpg
+import orjson
 from asyncpg.exceptions import UniqueViolationError
 from aiohttp import web
 
+try:
+    import fcntl  # flock очереди для бота; на Windows модуля нет — пишем/читаем без блокировки
+except ImportError:
+    fcntl = None
+
+try:
+    import uvloop  # быстрый event loop; в локальной разработке (Windows) его может не быть
+except ImportError:
+    uvloop = None
+
 # -------------------------------------------------
 # Config & logging
 # -------------------------------------------------
 
-logging.basicConfig(level=logging.INFO)
+# запись в stdout — в отдельном потоке, хендлеры запросов только кладут запись в очередь
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger("backend")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit())
 
 # ensure postgresql:// for asyncpg
 _database_url = os.getenv("DATABASE_URL", "postgres://postgres:postgres@db:5432/phe")
 DATABASE_URL = _database_url.replace("postgres://", "postgresql://", 1)
+# бот держит собственный пул на 20 соединений к той же БД — учитывайте это при max_connections
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
 
 WEBAPP_PATH = os.getenv("WEBAPP_PATH", "/app/webapp.html")
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")
 DEBUG_MODE = os.getenv("DEBUG_MODE", "false").lower() == "true"
+# для разработки: перечитывать webapp.html на каждый запрос вместо кэша в памяти
+WEBAPP_RELOAD = os.getenv("WEBAPP_RELOAD", "0") == "1"
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-ALLOWED_EXTS = {
-    "png", "jpg", "jpeg", "gif", "webp",
-    "pdf", "doc", "docx", "ppt", "pptx"
+# read_chunk() по умолчанию отдаёт по 8 KiB; пачки по 1 MiB — в 128 раз меньше итераций
+# цикла и обращений к тред-пулу aiofiles на тот же объём загрузки
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# набор разрешённых расширений фиксирован — MIME берём из таблицы, а не из mimetypes (он читает mime.types с диска)
+_EXT_MIME = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "pdf": "application/pdf",
+    "doc": "application/msword",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "ppt": "application/vnd.ms-powerpoint",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
 }
+ALLOWED_EXTS = frozenset(_EXT_MIME)
+_PHOTO_EXTS = frozenset({"png", "jpg", "jpeg", "gif", "webp"})
 
 logger.info(f"DEBUG_MODE: {DEBUG_MODE}")
 logger.info(f"ADMIN_IDS: {ADMIN_IDS}")
@@ -48,9 +91,40 @@ logger.info(f"DATABASE_URL: {DATABASE_URL}")
 # Helpers
 # -------------------------------------------------
 
-def _parse_init_data(raw: str) -> Dict[str, Any]:
-    parsed = urllib.parse.parse_qs(raw, keep_blank_values=True, strict_parsing=False)
-    return {k: v[0] for k, v in parsed.items()}
+AUTH_CACHE_TTL = 60.0  # секунд
+AUTH_CACHE_MAX = 10_000
+# LRU с TTL: при переполнении уходят истёкшие записи, затем самые давно использованные
+_auth_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+# список групп меняется редко — держим готовое JSON-тело. Бот тоже может создавать/удалять
+# группы (другой процесс), поэтому помимо явного сброса есть короткий TTL
+GROUPS_CACHE_TTL = 30.0  # секунд
+_groups_cache: Optional[Tuple[float, bytes]] = None
+
+# админка опрашивает вопросы и сдачи заданий с одними и теми же параметрами — готовые тела ответов
+# держим несколько секунд. Новые вопросы/сдачи пишет бот (другой процесс), поэтому только короткий TTL
+LIST_CACHE_TTL = 5.0  # секунд
+LIST_CACHE_MAX = 1024
+# LRU: при переполнении уходят сначала истёкшие записи, затем самые давно читанные
+_list_cache: "OrderedDict[Tuple[Any, ...], Tuple[float, bytes]]" = OrderedDict()
+
+def _split_init_data(raw: str) -> Tuple[str, str, Optional[str]]:
+    """initData → (hash, data_check_string, user JSON) за один проход по парам, без промежуточного dict."""
+    hash_hex = ""
+    user_json = None
+    pairs = []
+    for k, v in urllib.parse.parse_qsl(raw, keep_blank_values=True):
+        if k == "hash":
+            hash_hex = v
+            continue
+        if k == "user":
+            user_json = v
+        pairs.append((k, v))
+    pairs.sort()
+    return hash_hex, "\n".join(f"{k}={v}" for k, v in pairs), user_json
+
+# secret_key зависит только от токена бота — считаем один раз при загрузке модуля
+_TG_SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest() if BOT_TOKEN else b""
 
 def _check_telegram_signature(init_data: str, token: str) -> Tuple[bool, Dict[str, Any]]:
     if not token:
@@ -58,41 +132,162 @@ def _check_telegram_signature(init_data: str, token: str) -> Tuple[bool, Dict[st
     if not init_data:
         logger.warning("No init_data provided")
         return False, {}
+    # Mini App шлёт одну и ту же initData на каждый запрос — успешную проверку помним недолго
+    now = time.monotonic()
+    cached = _auth_cache.get(init_data)
+    if cached and cached[0] > now:
+        _auth_cache.move_to_end(init_data)
+        return True, cached[1]
     try:
-        parsed = _parse_init_data(init_data or "")
-        hash_hex = parsed.pop("hash", "")
-        data_check_string = "\n".join(f"{k}={parsed[k]}" for k in sorted(parsed.keys()))
-        secret_key = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
-        computed = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        ok = hmac.compare_digest(computed, hash_hex)
-        import json as _json
-        user_json = parsed.get("user")
-        user = _json.loads(user_json) if user_json else {}
+        hash_hex, data_check_string, user_json = _split_init_data(init_data)
+        # сравниваем сырые 32 байта, а не hex-строки; подпись другой длины отбрасываем сразу
+        try:
+            hash_bytes = bytes.fromhex(hash_hex)
+        except ValueError:
+            return False, {}
+        if len(hash_bytes) != 32:  # SHA-256
+            return False, {}
+        computed = hmac.new(_TG_SECRET_KEY, data_check_string.encode(), hashlib.sha256).digest()
+        ok = hmac.compare_digest(computed, hash_bytes)
+        user = orjson.loads(user_json) if user_json else {}
+        if ok:
+            _auth_cache.pop(init_data, None)
+            if len(_auth_cache) >= AUTH_CACHE_MAX:
+                for k in [k for k, (expires, _) in _auth_cache.items() if expires <= now]:
+                    del _auth_cache[k]
+                while len(_auth_cache) >= AUTH_CACHE_MAX:
+                    _auth_cache.popitem(last=False)
+            _auth_cache[init_data] = (now + AUTH_CACHE_TTL, user)
         return ok, user
     except Exception as e:
         logger.warning("Failed to verify initData: %s", e)
         return False, {}
 
-def _jsonify_record(record: asyncpg.Record) -> Dict[str, Any]:
-    obj = dict(record)
-    for k, v in list(obj.items()):
-        if isinstance(v, (datetime, date)):
-            obj[k] = v.isoformat()
-    return obj
+def _orjson_default(obj: Any) -> Any:
+    # asyncpg.Record отдаём как есть — без промежуточного списка словарей в хендлерах.
+    # items() идёт по значениям позиционно; dict(record) искал бы каждое поле по имени
+    if isinstance(obj, asyncpg.Record):
+        return dict(obj.items())
+    raise TypeError
+
+# наивные datetime (utcnow() и т.п.) отдаём с явным +00:00, как и timestamptz из БД
+_ORJSON_OPTS = orjson.OPT_NAIVE_UTC
+
+def json_response(data: Any, status: int = 200) -> web.Response:
+    """JSON-ответ через orjson (datetime/date сериализуются сами, в ISO 8601; asyncpg.Record — как объект)."""
+    return web.Response(
+        body=orjson.dumps(data, default=_orjson_default, option=_ORJSON_OPTS),
+        status=status,
+        content_type="application/json",
+    )
 
-def _jsonify_records(records: List[asyncpg.Record]) -> List[Dict[str, Any]]:
-    return [_jsonify_record(r) for r in records]
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, PATCH, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+}
+_PREFLIGHT_HEADERS = {**CORS_HEADERS, "Access-Control-Max-Age": "3600"}
+STREAM_FLUSH_BYTES = 64 * 1024
+STREAM_BATCH_ROWS = 500
+
+async def stream_json_rows(request: web.Request, pool: asyncpg.Pool, query: str, *args: Any) -> web.StreamResponse:
+    """
+    Отдаёт результат запроса JSON-массивом по мере чтения курсора: в памяти только текущая пачка,
+    первые байты уходят клиенту сразу.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # курсор и первая пачка — до prepare(): ошибки запроса и параметров (таймаут, обрыв
+            # соединения, переполнение int4) ещё доходят до error_middleware обычным JSON-ответом
+            cur = await conn.cursor(query, *args)
+            rows = await cur.fetch(STREAM_BATCH_ROWS)
+            resp = web.StreamResponse()
+            resp.content_type = "application/json"
+            await resp.prepare(request)
+            # статус 200 уже отправлен — error_middleware не должен подменять ответ
+            request["response_started"] = True
+            buf = bytearray(b"[")
+            first = True
+            while rows:
+                for row in rows:
+                    if not first:
+                        buf += b","
+                    first = False
+                    buf += orjson.dumps(row, default=_orjson_default, option=_ORJSON_OPTS)
+                if len(buf) >= STREAM_FLUSH_BYTES:
+                    await resp.write(bytes(buf))
+                    buf.clear()
+                if len(rows) < STREAM_BATCH_ROWS:
+                    break
+                rows = await cur.fetch(STREAM_BATCH_ROWS)
+    buf += b"]"
+    await resp.write(bytes(buf))
+    await resp.write_eof()
+    return resp
+
+# самый частый ответ — сериализуем один раз (сам Response переиспользовать нельзя: он одноразовый)
+_OK_BODY = orjson.dumps({"success": True})
+
+def ok_response() -> web.Response:
+    return web.Response(body=_OK_BODY, content_type="application/json")
+
+def _invalidate_groups_cache() -> None:
+    global _groups_cache
+    _groups_cache = None
+
+def _list_cache_get(key: Tuple[Any, ...]) -> Optional[web.Response]:
+    cached = _list_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        _list_cache.move_to_end(key)
+        return web.Response(body=cached[1], content_type="application/json")
+    return None
+
+def _list_cache_put(key: Tuple[Any, ...], rows: List[asyncpg.Record]) -> web.Response:
+    body = orjson.dumps(rows, default=_orjson_default, option=_ORJSON_OPTS)
+    now = time.monotonic()
+    _list_cache.pop(key, None)
+    if len(_list_cache) >= LIST_CACHE_MAX:
+        for k in [k for k, (expires, _) in _list_cache.items() if expires <= now]:
+            del _list_cache[k]
+        while len(_list_cache) >= LIST_CACHE_MAX:
+            _list_cache.popitem(last=False)
+    _list_cache[key] = (now + LIST_CACHE_TTL, body)
+    return web.Response(body=body, content_type="application/json")
+
+def _invalidate_list_cache(kind: str) -> None:
+    """Сбрасывает все закэшированные ответы одного вида ("questions", "submissions")."""
+    for key in [k for k in _list_cache if k[0] == kind]:
+        del _list_cache[key]
+
+def _text_field(data: Dict[str, Any], key: str) -> Optional[str]:
+    """Строковое поле тела запроса: обрезанное значение или None (нет поля, пустая строка, не строка)."""
+    value = data.get(key)
+    if not isinstance(value, str):
+        return None
+    return value.strip() or None
+
+def _parse_dt(value: Any) -> Optional[datetime]:
+    """ISO 8601 → datetime (Python 3.11+ сам понимает суффикс 'Z'). Пусто/мусор → None."""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        return datetime.fromisoformat(value.strip())
+    except ValueError as e:
+        logger.warning(f"Invalid datetime format: {value}, error: {e}")
+        return None
 
 def _safe_filename(name: str) -> str:
     name = os.path.basename(name or "")
     return name.replace("\x00", "")[:200] or f"file-{uuid.uuid4().hex}"
 
-def _ext_type(filename: str) -> Tuple[str, str]:
-    ext = (filename.rsplit(".", 1)[-1].lower() if "." in filename else "")
-    mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
-    if ext in {"png", "jpg", "jpeg", "gif", "webp"}:
-        return "photo", mime
-    return "document", mime
+def _file_ext(name: str) -> str:
+    """Расширение без точки в нижнем регистре ('' если его нет)."""
+    return os.path.splitext(name)[1][1:].lower()
+
+def _ext_type(ext: str) -> Tuple[str, str]:
+    """(тип отправки боту, MIME) по уже проверенному расширению файла."""
+    mime = _EXT_MIME.get(ext, "application/octet-stream")
+    return ("photo" if ext in _PHOTO_EXTS else "document"), mime
 
 def _guess_type_from_file_id(file_id: str) -> str:
     """
@@ -104,54 +299,98 @@ def _guess_type_from_file_id(file_id: str) -> str:
         return "document"
     # local:storedname.ext
     name_part = file_id.split(":", 1)[-1]
-    ext = name_part.rsplit(".", 1)[-1].lower() if "." in name_part else ""
-    if ext in {"png", "jpg", "jpeg", "gif", "webp"}:
+    ext = _file_ext(name_part)
+    if ext in _PHOTO_EXTS:
         return "photo"
     return "document"
 
-async def enqueue_action(action: str, data: Dict[str, Any]):
-    """Файловая очередь для взаимодействия с ботом (/tmp/bot_queue.json)."""
+# Очередь действий для бота. Хендлеры только кладут задачу в asyncio.Queue, а фоновый писатель
+# дописывает их в JSONL-файл (по строке на действие). Бот забирает файл под тем же flock
+# и обнуляет его — без перечитывания и перезаписи всей очереди на каждый запрос.
+BOT_QUEUE_FILE = os.getenv("BOT_QUEUE_FILE", "/tmp/bot_queue.jsonl")
+# в очереди уже готовые строки JSONL: сериализует enqueue_action, так что несериализуемый payload
+# падает у вызывающего хендлера, а не убивает фоновый писатель
+_bot_queue: Optional["asyncio.Queue[bytes]"] = None
+# строка JSONL целиком из orjson: перевод строки дописывается без копии через bytes + b"\n"
+_QUEUE_LINE_OPTS = _ORJSON_OPTS | orjson.OPT_APPEND_NEWLINE
+
+def _append_to_queue_file(fd: int, payload: bytes) -> None:
+    if fcntl is None:
+        os.write(fd, payload)
+        return
+    fcntl.flock(fd, fcntl.LOCK_EX)
     try:
-        queue_file = "/tmp/bot_queue.json"
-        queue: List[Dict[str, Any]] = []
-        if os.path.exists(queue_file):
-            try:
-                with open(queue_file, "r", encoding="utf-8") as f:
-                    queue = json.load(f)
-            except Exception:
-                queue = []
-        queue.append({"action": action, "data": data, "timestamp": datetime.utcnow().isoformat()})
-        with open(queue_file, "w", encoding="utf-8") as f:
-            json.dump(queue, f, ensure_ascii=False)
-        logger.info(f"Queued action '{action}'")
-    except Exception as e:
-        logger.error(f"Failed to enqueue {action}: {e}")
+        os.write(fd, payload)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+async def _bot_queue_writer(q: "asyncio.Queue[bytes]", fd: int):
+    while True:
+        batch = [await q.get()]
+        while not q.empty():
+            batch.append(q.get_nowait())
+        try:
+            await asyncio.to_thread(_append_to_queue_file, fd, b"".join(batch))
+        except Exception:
+            logger.exception("Failed to write %d queued action(s)", len(batch))
+
+async def bot_queue_ctx(app: web.Application):
+    global _bot_queue
+    # O_APPEND: бот обнуляет файл на месте, и следующая запись снова идёт с начала
+    fd = os.open(BOT_QUEUE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    _bot_queue = asyncio.Queue()
+    writer = asyncio.create_task(_bot_queue_writer(_bot_queue, fd))
+    yield
+    writer.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await writer
+    # то, что не успели записать до остановки, дописываем синхронно
+    leftover = []
+    while not _bot_queue.empty():
+        leftover.append(_bot_queue.get_nowait())
+    if leftover:
+        _append_to_queue_file(fd, b"".join(leftover))
+    _bot_queue = None
+    os.close(fd)
+
+def enqueue_action(action: str, data: Dict[str, Any]):
+    """
+    Ставит действие в очередь для бота. Обычная функция, а не корутина: put_nowait не ждёт,
+    запись в файл делает _bot_queue_writer — хендлер отвечает сразу после коммита в БД.
+    """
+    if _bot_queue is None:
+        logger.error("Bot queue is not running, dropping action '%s'", action)
+        return
+    line = orjson.dumps(
+        {"action": action, "data": data, "timestamp": datetime.utcnow().isoformat()},
+        option=_QUEUE_LINE_OPTS,
+    )
+    _bot_queue.put_nowait(line)
+    # ленивое %-форматирование: строка не собирается на пути запроса, если INFO отключён
+    logger.info("Queued action '%s'", action)
 
-async def notify_bot_new_assignment(assignment_data: Dict[str, Any]):
-    await enqueue_action("send_assignment_to_group", assignment_data)
+def notify_bot_new_assignment(assignment_data: Dict[str, Any]):
+    enqueue_action("send_assignment_to_group", assignment_data)
 
 # -------------------------------------------------
 # Auth helpers & decorators
 # -------------------------------------------------
 
-async def _require_admin(request: web.Request) -> int:
-    """
-    Разрешаем:
-      - аккаунты из ADMIN_IDS, всегда
-      - (УДАЛЕНО) подтверждённых пользователей с ролью teacher (из БД)
-    """
-    init_data = (
+def _get_init_data(request: web.Request) -> str:
+    return (
         request.headers.get("X-Telegram-Init-Data") or
         request.headers.get("Telegram-Init-Data") or
         request.query.get("initData") or
         ""
     )
 
-    # DEBUG: пропускаем и считаем учителем
-    if DEBUG_MODE and not ADMIN_IDS:
-        return 999_999
+def _telegram_user(request: web.Request) -> Tuple[int, Dict[str, Any]]:
+    """Проверенный (tg_id, user) из initData. Считается один раз на запрос, дальше берётся из request."""
+    cached = request.get("tg_user")
+    if cached is not None:
+        return cached
 
-    ok, user = _check_telegram_signature(init_data, BOT_TOKEN)
+    ok, user = _check_telegram_signature(_get_init_data(request), BOT_TOKEN)
     if not ok or not user:
         raise web.HTTPUnauthorized(text='{"detail":"Unauthorized"}', content_type="application/json")
 
@@ -159,6 +398,21 @@ async def _require_admin(request: web.Request) -> int:
     if tg_id <= 0:
         raise web.HTTPUnauthorized(text='{"detail":"Unauthorized"}', content_type="application/json")
 
+    request["tg_user"] = (tg_id, user)
+    return tg_id, user
+
+async def _require_admin(request: web.Request) -> int:
+    """
+    Разрешаем:
+      - аккаунты из ADMIN_IDS, всегда
+      - (УДАЛЕНО) подтверждённых пользователей с ролью teacher (из БД)
+    """
+    # DEBUG: пропускаем и считаем учителем
+    if DEBUG_MODE and not ADMIN_IDS:
+        return 999_999
+
+    tg_id, _ = _telegram_user(request)
+
     # === ИСПРАВЛЕНИЕ: Оставляем проверку ТОЛЬКО по ADMIN_IDS ===
     if tg_id in ADMIN_IDS:
         return tg_id
@@ -168,11 +422,56 @@ async def _require_admin(request: web.Request) -> int:
 
 
 def admin_required(handler):
-    async def wrapper(request: web.Request, *args, **kwargs):
-        uid = await _require_admin(request)
-        request["admin_user_id"] = uid
-        return await handler(request, *args, **kwargs)
-    return wrapper
+    """Помечает хендлер как админский; саму проверку делает admin_middleware — без обёртки на каждый вызов."""
+    handler.admin_only = True
+    return handler
+
+@web.middleware
+async def admin_middleware(request: web.Request, handler):
+    # смотрим на хендлер маршрута, а не на цепочку middleware; публичные пути проходят без разбора initData
+    if getattr(request.match_info.handler, "admin_only", False):
+        request["admin_user_id"] = await _require_admin(request)
+    return await handler(request)
+
+# telegram_id админа -> users.user_id; пользователи не удаляются, так что запись не устаревает
+_admin_uid_cache: Dict[int, int] = {}
+
+async def _admin_db_user_id(conn: asyncpg.Connection, admin_telegram_id: int) -> int:
+    """
+    user_id админа в users (нужен для created_by/answered_by). Если записи ещё нет — создаём её
+    вместе с teachers. Вызывать вне транзакции: откат не должен оставить в кэше несуществующий id.
+    """
+    cached = _admin_uid_cache.get(admin_telegram_id)
+    if cached is not None:
+        return cached
+
+    # один round-trip, как в /api/me: либо создаём админа (+teachers), либо берём существующую строку
+    user_id = await conn.fetchval(
+        """
+        WITH ins AS (
+            INSERT INTO users (telegram_id, first_name, last_name, role, approved)
+            VALUES ($1, 'Admin', 'User', 'teacher', TRUE)
+            ON CONFLICT (telegram_id) DO NOTHING
+            RETURNING user_id
+        ),
+        t AS (
+            INSERT INTO teachers (teacher_id)
+            SELECT user_id FROM ins
+            ON CONFLICT DO NOTHING
+        )
+        SELECT user_id FROM ins
+        UNION ALL
+        SELECT user_id FROM users WHERE telegram_id = $1
+        LIMIT 1
+        """,
+        admin_telegram_id
+    )
+    if user_id is None:
+        # строку одновременно вставил параллельный запрос — она не видна в снимке выражения выше
+        user_id = await conn.fetchval("SELECT user_id FROM users WHERE telegram_id = $1", admin_telegram_id)
+
+    _admin_uid_cache[admin_telegram_id] = user_id
+    return user_id
 
 
 # -------------------------------------------------
@@ -181,7 +480,27 @@ def admin_required(handler):
 
 async def create_pool(app: web.Application):
     logger.info("Connecting to DB: %s", DATABASE_URL)
-    app["db_pool"] = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+    app["db_pool"] = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,  # прогретые соединения: первые запросы после старта не ждут connect
+        max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=300,
+        command_timeout=30,
+        # все запросы — константные строки: подготовленные выражения живут столько же, сколько
+        # соединение, и горячие хендлеры не проходят Parse/Describe повторно
+        statement_cache_size=1024,
+        max_cached_statement_lifetime=0,
+        # короткие OLTP-запросы: JIT-компиляция плана стоит дороже самого запроса;
+        # application_name — чтобы отличать соединения backend'а от бота в pg_stat_activity
+        server_settings={"application_name": "vsilant-backend", "jit": "off"},
+    )
+    if ADMIN_IDS:
+        # админы, которые уже есть в БД, сразу попадают в кэш — send_* не ходят за их user_id
+        rows = await app["db_pool"].fetch(
+            "SELECT telegram_id, user_id FROM users WHERE telegram_id = ANY($1::bigint[])",
+            list(ADMIN_IDS)
+        )
+        _admin_uid_cache.update((r["telegram_id"], r["user_id"]) for r in rows)
     yield
     await app["db_pool"].close()
 
@@ -191,49 +510,59 @@ async def create_pool(app: web.Application):
 
 @admin_required
 async def health_handler(request: web.Request):
-    return web.json_response({"ok": True, "time": datetime.utcnow().isoformat()})
+    return json_response({"ok": True, "time": datetime.utcnow()})
+
+async def load_webapp(app: web.Application):
+    """Читаем webapp.html один раз при старте, дальше отдаём байты из памяти."""
+    try:
+        async with aiofiles.open(WEBAPP_PATH, "rb") as f:
+            app["webapp_html"] = await f.read()
+    except FileNotFoundError:
+        logger.warning("webapp.html not found at %s", WEBAPP_PATH)
+        app["webapp_html"] = None
 
 async def index_handler(request: web.Request):
-    if not os.path.exists(WEBAPP_PATH):
+    if WEBAPP_RELOAD:
+        # отсутствие файла FileResponse сам превращает в 404 (stat в executor), sendfile где доступен
+        return web.FileResponse(WEBAPP_PATH, chunk_size=256 * 1024)
+    body = request.app["webapp_html"]
+    if body is None:
         return web.Response(status=404, text="webapp.html not found")
-    return web.FileResponse(WEBAPP_PATH)
+    return web.Response(body=body, content_type="text/html", charset="utf-8")
 
 # ---------- /api/me ----------
 async def me_handler(request: web.Request):
-    init_data = (
-        request.headers.get("X-Telegram-Init-Data") or
-        request.headers.get("Telegram-Init-Data") or
-        request.query.get("initData") or
-        ""
-    )
-    if DEBUG_MODE and not init_data:
-        return web.json_response({"approved": True, "role": "teacher"})
+    if DEBUG_MODE and not _get_init_data(request):
+        return json_response({"approved": True, "role": "teacher"})
 
-    ok, user = _check_telegram_signature(init_data, BOT_TOKEN)
-    if not ok or not user:
-        raise web.HTTPUnauthorized(text='{"detail":"Unauthorized"}', content_type="application/json")
-
-    tg_id = int(user.get("id", 0)) if user.get("id") else 0
-    if tg_id <= 0:
-        raise web.HTTPUnauthorized(text='{"detail":"Unauthorized"}', content_type="application/json")
+    tg_id, user = _telegram_user(request)
 
     # ADMIN_IDS => всегда teacher
     if tg_id in ADMIN_IDS:
-        return web.json_response({"approved": True, "role": "teacher"})
+        return json_response({"approved": True, "role": "teacher"})
     
     # Остальные: проверяем/создаём запись
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT approved, role FROM users WHERE telegram_id=$1", tg_id)
-        if not row:
-            await conn.execute(
-                """
+        # один round-trip: вставка нового пользователя либо его существующая строка.
+        # Для уже зарегистрированных ничего не пишется (DO NOTHING, без UPDATE на каждое открытие)
+        row = await conn.fetchrow(
+            """
+            WITH ins AS (
                 INSERT INTO users(telegram_id, username, first_name, last_name, role, approved)
                 VALUES($1,$2,$3,$4,'pending',FALSE)
                 ON CONFLICT (telegram_id) DO NOTHING
-                """,
-                tg_id, user.get("username"), user.get("first_name") or "", user.get("last_name") or ""
+                RETURNING approved, role
             )
+            SELECT approved, role FROM ins
+            UNION ALL
+            SELECT approved, role FROM users WHERE telegram_id=$1
+            LIMIT 1
+            """,
+            tg_id, user.get("username"), user.get("first_name") or "", user.get("last_name") or ""
+        )
+        if not row:
+            # строку одновременно вставил параллельный запрос — она не видна в снимке выражения выше
             row = await conn.fetchrow("SELECT approved, role FROM users WHERE telegram_id=$1", tg_id)
 
     # Не выдаём роль teacher без ADMIN_IDS
@@ -241,21 +570,25 @@ async def me_handler(request: web.Request):
     if role_to_return == "teacher":
         role_to_return = "student"
 
-    return web.json_response({"approved": bool(row["approved"]), "role": role_to_return})
+    return json_response({"approved": bool(row["approved"]), "role": role_to_return})
 
 # --------- Groups ----------
 
 @admin_required
 async def groups_get(request: web.Request):
-    pool: asyncpg.Pool = request.app["db_pool"]
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT group_id, name FROM groups ORDER BY name")
-    return web.json_response(_jsonify_records(rows))
+    global _groups_cache
+    now = time.monotonic()
+    if _groups_cache is None or _groups_cache[0] <= now:
+        pool: asyncpg.Pool = request.app["db_pool"]
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("SELECT group_id, name FROM groups ORDER BY name")
+        _groups_cache = (now + GROUPS_CACHE_TTL, orjson.dumps(rows, default=_orjson_default, option=_ORJSON_OPTS))
+    return web.Response(body=_groups_cache[1], content_type="application/json")
 
 @admin_required
 async def groups_post(request: web.Request):
-    data = await request.json()
-    name = (data.get("name") or "").strip()
+    data = await request.json(loads=orjson.loads)
+    name = _text_field(data, "name") or ""
     if not name:
         raise web.HTTPBadRequest(text='{"detail":"Missing name"}', content_type="application/json")
     pool: asyncpg.Pool = request.app["db_pool"]
@@ -266,7 +599,8 @@ async def groups_post(request: web.Request):
             )
         except UniqueViolationError:
             raise web.HTTPConflict(text='{"detail":"Group exists"}', content_type="application/json")
-    return web.json_response(_jsonify_record(row), status=201)
+    _invalidate_groups_cache()
+    return json_response(row, status=201)
 
 @admin_required
 async def group_delete(request: web.Request):
@@ -274,12 +608,41 @@ async def group_delete(request: web.Request):
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
         status = await conn.execute("DELETE FROM groups WHERE group_id=$1", gid)
-    if status.startswith("DELETE"):
-        return web.json_response({"success": True})
+    # asyncpg возвращает "DELETE <n>" — существование проверяем по числу строк, без отдельного SELECT
+    if status != "DELETE 0":
+        _invalidate_groups_cache()
+        return ok_response()
     raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
 
 # --------- Users ----------
 
+USERS_SQL = """
+    SELECT u.user_id, u.telegram_id, u.username, u.first_name, u.last_name,
+           u.role, u.approved,
+           s.group_id,
+           g.name AS group_name
+    FROM users u
+    LEFT JOIN students s ON s.student_id = u.user_id
+    LEFT JOIN groups g ON g.group_id = s.group_id
+    WHERE ($1::text IS NULL OR u.role = $1)
+      AND ($2::bool IS NULL OR u.approved = $2)
+    ORDER BY u.last_name, u.first_name
+"""
+
+USERS_OF_GROUP_SQL = """
+    SELECT u.user_id, u.telegram_id, u.username, u.first_name, u.last_name,
+           u.role, u.approved,
+           s.group_id,
+           g.name AS group_name
+    FROM students s
+    JOIN users u ON u.user_id = s.student_id
+    JOIN groups g ON g.group_id = s.group_id
+    WHERE s.group_id = $2
+      AND ($1::text IS NULL OR u.role = $1)
+      AND ($3::bool IS NULL OR u.approved = $3)
+    ORDER BY u.last_name, u.first_name
+"""
+
 @admin_required
 async def users_get(request: web.Request):
     q = request.query
@@ -294,152 +657,195 @@ async def users_get(request: web.Request):
     else:
         approved_val = None
 
-    pool: asyncpg.Pool = request.app["db_pool"]
-    async with pool.acquire() as conn:
-        base = """
-            SELECT u.user_id, u.telegram_id, u.username, u.first_name, u.last_name,
-                   u.role, u.approved,
-                   s.group_id,
-                   g.name AS group_name
-            FROM users u
-            LEFT JOIN students s ON s.student_id = u.user_id
-            LEFT JOIN groups g ON g.group_id = s.group_id
-            WHERE 1=1
-        """
-        args: List[Any] = []
-        if role:
-            args.append(role)
-            base += f" AND u.role = ${len(args)}"
-        if gid is not None:
-            args.append(gid)
-            base += f" AND s.group_id = ${len(args)}"
-        if approved_val is not None:
-            args.append(approved_val)
-            base += f" AND u.approved = ${len(args)}"
-        base += " ORDER BY u.last_name, u.first_name"
-        rows = await conn.fetch(base, *args)
-    return web.json_response(_jsonify_records(rows))
+    # без фильтров это весь список пользователей — стримим курсором, а не собираем в память
+    if gid is not None:
+        # список группы: идём от students по idx_students_group_id, пользователей — по PK
+        return await stream_json_rows(
+            request, request.app["db_pool"], USERS_OF_GROUP_SQL, role or None, gid, approved_val
+        )
+    return await stream_json_rows(request, request.app["db_pool"], USERS_SQL, role or None, approved_val)
 
 @admin_required
 async def user_approve(request: web.Request):
     uid = int(request.match_info["user_id"])
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     approved = data.get("approved")
     if not isinstance(approved, bool):
         raise web.HTTPBadRequest(text='{"detail":"Bad status"}', content_type="application/json")
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        # узнаем текущий статус и telegram_id
+        # обновляем и сразу получаем прежний статус и telegram_id — один запрос
         row = await conn.fetchrow(
-            "SELECT approved, telegram_id FROM users WHERE user_id=$1",
-            uid
+            """
+            UPDATE users u
+            SET approved=$1
+            FROM (SELECT user_id, approved FROM users WHERE user_id=$2 FOR UPDATE) prev
+            WHERE u.user_id = prev.user_id
+            RETURNING prev.approved AS prev_approved, u.telegram_id
+            """,
+            approved, uid
         )
-        if not row:
-            raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
-        prev_approved = bool(row["approved"])
-        student_tid = int(row["telegram_id"]) if row["telegram_id"] else None
-
-        status = await conn.execute("UPDATE users SET approved=$1 WHERE user_id=$2", approved, uid)
-
-    if not status.startswith("UPDATE"):
+    if not row:
         raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
+    prev_approved = bool(row["prev_approved"])
+    student_tid = int(row["telegram_id"]) if row["telegram_id"] else None
 
     # если впервые одобрили — уведомим ученика и дадим кнопку "Открыть меню"
     if approved and not prev_approved and student_tid:
-        await enqueue_action("notify_user_approval", {
+        enqueue_action("notify_user_approval", {
             "student_telegram_id": student_tid,
             "button_text": "Открыть меню"
         })
 
-    return web.json_response({"success": True})
+    return ok_response()
+
+@admin_required
+async def users_approve_bulk(request: web.Request):
+    """Массовое одобрение/отклонение: один UPDATE по массиву id вместо N запросов."""
+    data = await request.json(loads=orjson.loads)
+    approved = data.get("approved")
+    ids = data.get("user_ids")
+    if not isinstance(approved, bool) or not isinstance(ids, list) or not ids:
+        raise web.HTTPBadRequest(text='{"detail":"Bad request"}', content_type="application/json")
+    try:
+        ids = list({int(x) for x in ids})
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text='{"detail":"Bad user_ids"}', content_type="application/json")
+
+    pool: asyncpg.Pool = request.app["db_pool"]
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            UPDATE users u
+            SET approved=$1
+            FROM (SELECT user_id, approved FROM users WHERE user_id = ANY($2::bigint[]) FOR UPDATE) prev
+            WHERE u.user_id = prev.user_id
+            RETURNING u.user_id, prev.approved AS prev_approved, u.telegram_id
+            """,
+            approved, ids
+        )
+
+    if approved:
+        for r in rows:
+            if not r["prev_approved"] and r["telegram_id"]:
+                enqueue_action("notify_user_approval", {
+                    "student_telegram_id": int(r["telegram_id"]),
+                    "button_text": "Открыть меню"
+                })
+
+    return json_response({"success": True, "count": len(rows), "user_ids": [r["user_id"] for r in rows]})
 
 @admin_required
 async def user_role(request: web.Request):
     uid = int(request.match_info["user_id"])
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     role = data.get("role")
     if role not in ("student", "teacher", "pending"):
         raise web.HTTPBadRequest(text='{"detail":"Bad role"}', content_type="application/json")
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            status = await conn.execute("UPDATE users SET role=$1 WHERE user_id=$2", role, uid)
-            if not status.startswith("UPDATE"):
-                raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
-            if role == "student":
-                await conn.execute(
-                    "INSERT INTO students (student_id) VALUES ($1) ON CONFLICT (student_id) DO NOTHING",
-                    uid,
-                )
-            else:
-                await conn.execute("DELETE FROM students WHERE student_id=$1", uid)
-    return web.json_response({"success": True})
+        # одно выражение вместо транзакции из двух: блокировки держатся один round-trip;
+        # вставка идёт от upd, так что для несуществующего пользователя ничего не меняется
+        row = await conn.fetchrow(
+            """
+            WITH upd AS (
+                UPDATE users SET role=$1 WHERE user_id=$2 RETURNING user_id
+            ),
+            del_s AS (
+                DELETE FROM students WHERE student_id=$2 AND $1::text <> 'student'
+            ),
+            ins_s AS (
+                INSERT INTO students (student_id)
+                SELECT user_id FROM upd WHERE $1::text = 'student'
+                ON CONFLICT (student_id) DO NOTHING
+            )
+            SELECT user_id FROM upd
+            """,
+            role, uid
+        )
+    if not row:
+        raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
+    return ok_response()
 
 @admin_required
 async def user_group(request: web.Request):
     uid = int(request.match_info["user_id"])
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     gid = data.get("group_id")
+    if gid is not None:
+        try:
+            gid = int(gid)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text='{"detail":"Bad group_id"}', content_type="application/json")
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
+        # если группа не меняется — строку не переписываем (нет лишней записи в WAL)
         if gid is not None:
-            status = await conn.execute(
-                "UPDATE students SET group_id=$1 WHERE student_id=$2",
-                int(gid), uid
+            await conn.execute(
+                """
+                INSERT INTO students(student_id, group_id)
+                VALUES($1,$2)
+                ON CONFLICT (student_id) DO UPDATE SET group_id=EXCLUDED.group_id
+                WHERE students.group_id IS DISTINCT FROM EXCLUDED.group_id
+                """,
+                uid, gid
             )
-            if status == "UPDATE 0":
-                await conn.execute(
-                    """
-                    INSERT INTO students(student_id, group_id)
-                    VALUES($1,$2)
-                    ON CONFLICT (student_id) DO UPDATE SET group_id=EXCLUDED.group_id
-                    """,
-                    uid, int(gid)
-                )
         else:
-            await conn.execute("UPDATE students SET group_id=NULL WHERE student_id=$1", uid)
-    return web.json_response({"success": True})
+            await conn.execute(
+                "UPDATE students SET group_id=NULL WHERE student_id=$1 AND group_id IS NOT NULL",
+                uid
+            )
+    return ok_response()
 
 # --------- Pending Changes ----------
 
+PENDING_GROUP_CHANGES_SQL = """
+    SELECT u.user_id, u.first_name, u.last_name,
+           s.group_id AS current_group_id, g1.name AS current_group_name,
+           s.pending_group_id, g2.name AS pending_group_name
+    FROM users u
+    JOIN students s ON s.student_id = u.user_id
+    LEFT JOIN groups g1 ON g1.group_id = s.group_id
+    LEFT JOIN groups g2 ON g2.group_id = s.pending_group_id
+    WHERE s.pending_group_id IS NOT NULL
+    ORDER BY u.last_name, u.first_name
+"""
+
+PENDING_NAME_CHANGES_SQL = """
+    SELECT user_id,
+           first_name AS current_first_name, last_name AS current_last_name,
+           pending_first_name, pending_last_name
+    FROM users
+    WHERE pending_first_name IS NOT NULL
+    ORDER BY last_name, first_name
+"""
+
 @admin_required
 async def pending_group_changes_get(request: web.Request):
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT u.user_id, u.first_name, u.last_name,
-                   s.group_id AS current_group_id, g1.name AS current_group_name,
-                   s.pending_group_id, g2.name AS pending_group_name
-            FROM users u
-            JOIN students s ON s.student_id = u.user_id
-            LEFT JOIN groups g1 ON g1.group_id = s.group_id
-            LEFT JOIN groups g2 ON g2.group_id = s.pending_group_id
-            WHERE s.pending_group_id IS NOT NULL
-            ORDER BY u.last_name, u.first_name
-            """
-        )
-    return web.json_response(_jsonify_records(rows))
+        rows = await conn.fetch(PENDING_GROUP_CHANGES_SQL)
+    return json_response(rows)
 
 @admin_required
 async def approve_group_change(request: web.Request):
     uid = int(request.match_info["user_id"])
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            row = await conn.fetchrow("SELECT pending_group_id FROM students WHERE student_id=$1 FOR UPDATE", uid)
-            if not row or row["pending_group_id"] is None:
-                raise web.HTTPNotFound(text='{"detail":"No pending group"}', content_type="application/json")
-            await conn.execute(
-                """
-                UPDATE students
-                SET group_id=$1, pending_group_id=NULL, group_change_requested_at=NULL
-                WHERE student_id=$2
-                """,
-                row["pending_group_id"], uid
-            )
-    return web.json_response({"success": True})
+        # SET читает старые значения строки — заявка переносится одним UPDATE, без SELECT FOR UPDATE
+        row = await conn.fetchrow(
+            """
+            UPDATE students
+            SET group_id=pending_group_id, pending_group_id=NULL, group_change_requested_at=NULL
+            WHERE student_id=$1 AND pending_group_id IS NOT NULL
+            RETURNING student_id
+            """,
+            uid
+        )
+    if not row:
+        raise web.HTTPNotFound(text='{"detail":"No pending group"}', content_type="application/json")
+    return ok_response()
 
 @admin_required
 async def reject_group_change(request: web.Request):
@@ -449,51 +855,57 @@ async def reject_group_change(request: web.Request):
         await conn.execute(
             """
             UPDATE students
-            SET pending_group_id=NULL, name_change_requested_at=NULL, group_change_requested_at=NULL
+            SET pending_group_id=NULL, group_change_requested_at=NULL
             WHERE student_id=$1
             """,
             uid
         )
-    return web.json_response({"success": True})
+    return ok_response()
 
 @admin_required
 async def pending_name_changes_get(request: web.Request):
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT user_id,
-                   first_name AS current_first_name, last_name AS current_last_name,
-                   pending_first_name, pending_last_name
-            FROM users
-            WHERE pending_first_name IS NOT NULL
-            ORDER BY last_name, first_name
-            """
-        )
-    return web.json_response(_jsonify_records(rows))
+        rows = await conn.fetch(PENDING_NAME_CHANGES_SQL)
+    return json_response(rows)
+
+@admin_required
+async def admin_overview(request: web.Request):
+    """
+    Всё для вкладки заявок одним HTTP-запросом: новые пользователи, смены группы и имени.
+    Три выборки идут параллельно, каждая на своём соединении из пула.
+    """
+    pool: asyncpg.Pool = request.app["db_pool"]
+
+    async def fetch(query: str, *args: Any) -> List[asyncpg.Record]:
+        async with pool.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+    users, group_changes, name_changes = await asyncio.gather(
+        fetch(USERS_SQL, "pending", False),
+        fetch(PENDING_GROUP_CHANGES_SQL),
+        fetch(PENDING_NAME_CHANGES_SQL),
+    )
+    return json_response({"users": users, "group_changes": group_changes, "name_changes": name_changes})
 
 @admin_required
 async def approve_name_change(request: web.Request):
     uid = int(request.match_info["user_id"])
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            row = await conn.fetchrow(
-                "SELECT pending_first_name, pending_last_name FROM users WHERE user_id=$1 FOR UPDATE",
-                uid
-            )
-            if not row or not row["pending_first_name"]:
-                raise web.HTTPNotFound(text='{"detail":"No pending name"}', content_type="application/json")
-            await conn.execute(
-                """
-                UPDATE users
-                SET first_name=$1, last_name=$2,
-                    pending_first_name=NULL, pending_last_name=NULL, name_change_requested_at=NULL
-                WHERE user_id=$3
-                """,
-                row["pending_first_name"], row["pending_last_name"], uid
-            )
-    return web.json_response({"success": True})
+        row = await conn.fetchrow(
+            """
+            UPDATE users
+            SET first_name=pending_first_name, last_name=pending_last_name,
+                pending_first_name=NULL, pending_last_name=NULL, name_change_requested_at=NULL
+            WHERE user_id=$1 AND pending_first_name <> ''
+            RETURNING user_id
+            """,
+            uid
+        )
+    if not row:
+        raise web.HTTPNotFound(text='{"detail":"No pending name"}', content_type="application/json")
+    return ok_response()
 
 @admin_required
 async def reject_name_change(request: web.Request):
@@ -508,7 +920,7 @@ async def reject_name_change(request: web.Request):
             """,
             uid
         )
-    return web.json_response({"success": True})
+    return ok_response()
 
 # --------- Attendance (per-date input) ----------
 
@@ -532,11 +944,11 @@ async def attendance_get(request: web.Request):
             """,
             gid, adate
         )
-    return web.json_response(_jsonify_records(rows))
+    return json_response(rows)
 
 @admin_required
 async def attendance_post(request: web.Request):
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     try:
         gid = int(data["group_id"])
         adate = date.fromisoformat(data["date"])
@@ -544,19 +956,32 @@ async def attendance_post(request: web.Request):
         raise web.HTTPBadRequest(text='{"detail":"Bad group_id/date"}', content_type="application/json")
 
     items: List[Dict[str, Any]] = data.get("attendance") or []
+    try:
+        student_ids = [int(item["student_id"]) for item in items]
+    except (KeyError, TypeError, ValueError):
+        raise web.HTTPBadRequest(text='{"detail":"Bad student_id"}', content_type="application/json")
+    presents = [bool(item.get("is_present", True)) for item in items]
+
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("DELETE FROM attendance WHERE group_id=$1 AND attendance_date=$2", gid, adate)
-            for item in items:
-                await conn.execute(
-                    """
-                    INSERT INTO attendance(group_id, student_id, attendance_date, is_present)
-                    VALUES($1,$2,$3,$4)
-                    """,
-                    gid, int(item["student_id"]), adate, bool(item.get("is_present", True))
-                )
-    return web.json_response({"success": True})
+        # один запрос: upsert всей группы по параллельным массивам + удаление тех, кого нет в списке.
+        # Неизменившиеся отметки не переписываются — без мёртвых строк и лишнего WAL
+        await conn.execute(
+            """
+            WITH removed AS (
+                DELETE FROM attendance
+                WHERE group_id=$1 AND attendance_date=$2 AND student_id <> ALL($3::bigint[])
+            )
+            INSERT INTO attendance(group_id, student_id, attendance_date, is_present)
+            SELECT $1, t.sid, $2, t.pres
+            FROM unnest($3::bigint[], $4::bool[]) AS t(sid, pres)
+            ON CONFLICT (group_id, student_id, attendance_date)
+            DO UPDATE SET is_present=EXCLUDED.is_present, marked_at=CURRENT_TIMESTAMP
+            WHERE attendance.is_present IS DISTINCT FROM EXCLUDED.is_present
+            """,
+            gid, adate, student_ids, presents
+        )
+    return ok_response()
 
 # --------- Attendance: stats & tracked dates ----------
 
@@ -569,22 +994,24 @@ async def attendance_tracked_dates(request: web.Request):
     except (KeyError, ValueError):
         raise web.HTTPBadRequest(text='{"detail":"Bad or missing group_id"}', content_type="application/json")
 
-    date_from = q.get("date_from")
-    date_to = q.get("date_to")
+    date_from = date.fromisoformat(q["date_from"]) if q.get("date_from") else None
+    date_to = date.fromisoformat(q["date_to"]) if q.get("date_to") else None
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        sql = "SELECT DISTINCT attendance_date FROM attendance WHERE group_id=$1"
-        args: List[Any] = [gid]
-        if date_from:
-            sql += f" AND attendance_date >= ${len(args)+1}"
-            args.append(date.fromisoformat(date_from))
-        if date_to:
-            sql += f" AND attendance_date <= ${len(args)+1}"
-            args.append(date.fromisoformat(date_to))
-        sql += " ORDER BY attendance_date DESC"
-        rows = await conn.fetch(sql, *args)
-    return web.json_response([r["attendance_date"].isoformat() for r in rows])
+        # один текст запроса для любых фильтров — план берётся из кэша asyncpg
+        rows = await conn.fetch(
+            """
+            SELECT DISTINCT attendance_date
+            FROM attendance
+            WHERE group_id=$1
+              AND ($2::date IS NULL OR attendance_date >= $2)
+              AND ($3::date IS NULL OR attendance_date <= $3)
+            ORDER BY attendance_date DESC
+            """,
+            gid, date_from, date_to
+        )
+    return json_response([r["attendance_date"] for r in rows])
 
 @admin_required
 async def attendance_stats_group(request: web.Request):
@@ -603,8 +1030,10 @@ async def attendance_stats_group(request: web.Request):
         rows = await conn.fetch(
             """
             SELECT u.user_id, u.first_name, u.last_name,
-                   COALESCE(SUM(CASE WHEN a.is_present THEN 1 ELSE 0 END), 0) AS total_present,
-                   COALESCE(COUNT(a.attendance_id), 0) AS total_tracked
+                   COUNT(a.attendance_id) FILTER (WHERE a.is_present) AS total_present,
+                   COUNT(a.attendance_id) AS total_tracked,
+                   (COUNT(a.attendance_id) FILTER (WHERE a.is_present) * 100.0
+                    / NULLIF(COUNT(a.attendance_id), 0))::float8 AS percent_present
             FROM students s
             JOIN users u ON u.user_id = s.student_id
             LEFT JOIN attendance a
@@ -616,20 +1045,8 @@ async def attendance_stats_group(request: web.Request):
             """,
             gid
         )
-    result = []
-    for r in rows:
-        total_tracked = int(r["total_tracked"])
-        total_present = int(r["total_present"])
-        percent = (total_present / total_tracked * 100.0) if total_tracked > 0 else None
-        result.append({
-            "user_id": r["user_id"],
-            "first_name": r["first_name"],
-            "last_name": r["last_name"],
-            "total_present": total_present,
-            "total_tracked": total_tracked,
-            "percent_present": percent,
-        })
-    return web.json_response(result)
+    # процент считает Postgres (NULL, если отметок не было) — строки отдаём как есть
+    return json_response(rows)
 
 @admin_required
 async def attendance_stats_student(request: web.Request):
@@ -644,42 +1061,40 @@ async def attendance_stats_student(request: web.Request):
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        # определим группу студента
-        st = await conn.fetchrow("SELECT group_id FROM students WHERE student_id=$1", sid)
-        if not st or st["group_id"] is None:
-            return web.json_response([])
-
-        gid = int(st["group_id"])
+        # группа студента определяется джойном — один запрос вместо двух
         rows = await conn.fetch(
             """
-            SELECT attendance_date, is_present
-            FROM attendance
-            WHERE group_id=$1 AND student_id=$2
-            ORDER BY attendance_date DESC
+            SELECT a.attendance_date, a.is_present
+            FROM students s
+            JOIN attendance a ON a.group_id = s.group_id AND a.student_id = s.student_id
+            WHERE s.student_id=$1
+            ORDER BY a.attendance_date DESC
             """,
-            gid, sid
+            sid
         )
-    return web.json_response([{"date": r["attendance_date"].isoformat(), "is_present": r["is_present"]} for r in rows])
+    return json_response([{"date": r["attendance_date"], "is_present": r["is_present"]} for r in rows])
 
 # --------- Assignments & Submissions ----------
 
 @admin_required
 async def assignments_get(request: web.Request):
     q = request.query
-    gid = int(q["group_id"])
-    pool: asyncpg.Pool = request.app["db_pool"]
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT assignment_id, group_id, title, description,
-                   file_id, file_type, due_date, accepting_submissions
-            FROM assignments
-            WHERE group_id=$1
-            ORDER BY assignment_id DESC
-            """,
-            gid
-        )
-    return web.json_response(_jsonify_records(rows))
+    try:
+        gid = int(q["group_id"])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text='{"detail":"Bad or missing group_id"}', content_type="application/json")
+    # список заданий группы только растёт — стримим курсором, как /api/users
+    return await stream_json_rows(
+        request, request.app["db_pool"],
+        """
+        SELECT assignment_id, group_id, title, description,
+               file_id, file_type, due_date, accepting_submissions
+        FROM assignments
+        WHERE group_id=$1
+        ORDER BY assignment_id DESC
+        """,
+        gid
+    )
 
 @admin_required
 async def assignment_detail(request: web.Request):
@@ -697,101 +1112,66 @@ async def assignment_detail(request: web.Request):
         )
     if not row:
         raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
-    return web.json_response(_jsonify_record(row))
+    return json_response(row)
 
 @admin_required
 async def send_assignment(request: web.Request):
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     admin_telegram_id = request.get("admin_user_id")
 
     try:
         group_id = int(data["group_id"])
-        title = (data.get("title") or "").strip()
+        title = _text_field(data, "title") or ""
     except (KeyError, ValueError, TypeError):
         raise web.HTTPBadRequest(text='{"detail":"Missing or invalid group_id/title"}', content_type="application/json")
 
     if not title:
         raise web.HTTPBadRequest(text='{"detail":"Title cannot be empty"}', content_type="application/json")
 
-    description = (data.get("description") or "").strip() or None
-    file_id = (data.get("file_id") or "").strip() or None
-    file_type = (data.get("file_type") or "").strip() or None
-    due_date_str = (data.get("due_date") or "").strip()
-
-    due_date = None
-    if due_date_str:
-        try:
-            due_date = datetime.fromisoformat(due_date_str.replace('Z', '+00:00'))
-        except (ValueError, AttributeError) as e:
-            logger.warning(f"Invalid due_date format: {due_date_str}, error: {e}")
-            due_date = None
+    description = _text_field(data, "description")
+    file_id = _text_field(data, "file_id")
+    file_type = _text_field(data, "file_type")
+    due_date = _parse_dt(data.get("due_date"))
 
     pool: asyncpg.Pool = request.app["db_pool"]
 
     try:
         async with pool.acquire() as conn:
-            admin_user = await conn.fetchrow(
-                "SELECT user_id FROM users WHERE telegram_id = $1",
-                admin_telegram_id
-            )
-
-            if not admin_user:
-                logger.warning(f"Admin {admin_telegram_id} not in DB, creating record")
-                admin_user = await conn.fetchrow(
-                    """
-                    INSERT INTO users (telegram_id, first_name, last_name, role, approved)
-                    VALUES ($1, 'Admin', 'User', 'teacher', TRUE)
-                    RETURNING user_id
-                    """,
-                    admin_telegram_id
-                )
-                await conn.execute(
-                    "INSERT INTO teachers (teacher_id) VALUES ($1) ON CONFLICT DO NOTHING",
-                    admin_user['user_id']
-                )
-
-            admin_user_id = admin_user['user_id']
+            admin_user_id = await _admin_db_user_id(conn, admin_telegram_id)
 
-            if due_date:
-                row = await conn.fetchrow(
-                    """
-                    INSERT INTO assignments(group_id, title, description, file_id, file_type, due_date, created_by, accepting_submissions)
-                    VALUES($1, $2, $3, $4, $5, $6, $7, TRUE)
-                    RETURNING assignment_id, group_id, title, description, file_id, file_type, due_date, accepting_submissions
-                    """,
-                    group_id, title, description, file_id, file_type, due_date, admin_user_id
-                )
-            else:
-                row = await conn.fetchrow(
-                    """
-                    INSERT INTO assignments(group_id, title, description, file_id, file_type, created_by, accepting_submissions)
-                    VALUES($1, $2, $3, $4, $5, $6, TRUE)
-                    RETURNING assignment_id, group_id, title, description, file_id, file_type, due_date, accepting_submissions
-                    """,
-                    group_id, title, description, file_id, file_type, admin_user_id
-                )
-
-        result = _jsonify_record(row)
+            # due_date без значения — просто NULL, отдельная ветка INSERT не нужна
+            row = await conn.fetchrow(
+                """
+                INSERT INTO assignments(group_id, title, description, file_id, file_type, due_date, created_by, accepting_submissions)
+                VALUES($1, $2, $3, $4, $5, $6, $7, TRUE)
+                RETURNING assignment_id, group_id, title, description, file_id, file_type, due_date, accepting_submissions
+                """,
+                group_id, title, description, file_id, file_type, due_date, admin_user_id
+            )
 
-        await notify_bot_new_assignment({
-            'assignment_id': result['assignment_id'],
-            'group_id': result['group_id'],
-            'title': result['title'],
-            'description': result.get('description'),
-            'due_date': result.get('due_date'),
-            'file_id': result.get('file_id'),
-            'file_type': result.get('file_type')
+        notify_bot_new_assignment({
+            'assignment_id': row['assignment_id'],
+            'group_id': row['group_id'],
+            'title': row['title'],
+            'description': row['description'],
+            'due_date': row['due_date'],
+            'file_id': row['file_id'],
+            'file_type': row['file_type']
         })
 
-        return web.json_response(result, status=201)
+        return json_response(row, status=201)
 
-    except Exception as e:
-        logger.exception(f"Error creating assignment: {e}")
+    except Exception:
+        logger.exception("Error creating assignment")
         raise web.HTTPInternalServerError(text='{"detail":"Failed to create assignment"}', content_type="application/json")
 
 @admin_required
 async def assignment_submissions(request: web.Request):
     aid = int(request.match_info["assignment_id"])
+    cache_key = ("submissions", aid)
+    cached = _list_cache_get(cache_key)
+    if cached is not None:
+        return cached
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
@@ -799,47 +1179,55 @@ async def assignment_submissions(request: web.Request):
             """
             SELECT submission_id, assignment_id, student_id,
                    file_id, submission_date, is_late,
-                   submitted, grade, score1, score2, teacher_comment, grade_date
+                   submitted, grade, score1, score2, teacher_comment, grade_date,
+                   (grade IS NOT NULL OR teacher_comment IS NOT NULL
+                    OR grade_date IS NOT NULL) AS is_graded
             FROM submissions
             WHERE assignment_id=$1
             ORDER BY submission_date DESC
             """,
             aid
         )
-    # добавляем вычисляемое поле is_graded
-    out = []
-    for r in rows:
-        d = _jsonify_record(r)
-        d["is_graded"] = (r["grade"] is not None) or (r["teacher_comment"] is not None) or (r["grade_date"] is not None)
-        out.append(d)
-    return web.json_response(out)
+    return _list_cache_put(cache_key, rows)
+
+# горячие UPDATE'ы админки (переключение приёма, оценка, ответ на вопрос) — один текст на процесс:
+# asyncpg держит их подготовленными на каждом соединении пула (statement_cache_size в create_pool)
+TOGGLE_SUBMISSION_SQL = """
+    UPDATE assignments
+    SET accepting_submissions=$1
+    WHERE assignment_id=$2
+    RETURNING assignment_id, accepting_submissions
+"""
 
 @admin_required
 async def toggle_submission(request: web.Request):
     aid = int(request.match_info["assignment_id"])
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     accept = data.get("accept")
     if not isinstance(accept, bool):
         raise web.HTTPBadRequest(text='{"detail":"Bad status"}', content_type="application/json")
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            UPDATE assignments
-            SET accepting_submissions=$1
-            WHERE assignment_id=$2
-            RETURNING assignment_id, accepting_submissions
-            """,
-            accept, aid
-        )
+        row = await conn.fetchrow(TOGGLE_SUBMISSION_SQL, accept, aid)
     if not row:
         raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
-    return web.json_response(_jsonify_record(row))
+    return json_response(row)
+
+GRADE_SUBMISSION_SQL = """
+    UPDATE submissions s
+    SET grade=$1, teacher_comment=$2, grade_date=NOW()
+    FROM users u, assignments a
+    WHERE s.submission_id=$3
+      AND u.user_id = s.student_id
+      AND a.assignment_id = s.assignment_id
+    RETURNING s.submission_id, s.grade, s.teacher_comment, s.grade_date,
+              s.assignment_id, u.telegram_id, a.title
+"""
 
 @admin_required
 async def submission_grade(request: web.Request):
-    sid = int(request.match_info()["submission_id"])
-    data = await request.json()
+    sid = int(request.match_info["submission_id"])
+    data = await request.json(loads=orjson.loads)
     grade = data.get("grade")
     comment = data.get("comment")
 
@@ -854,43 +1242,29 @@ async def submission_grade(request: web.Request):
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
-        details = await conn.fetchrow(
-            """
-            SELECT s.assignment_id, s.student_id, u.telegram_id, a.title
-            FROM submissions s
-            JOIN users u ON u.user_id = s.student_id
-            JOIN assignments a ON a.assignment_id = s.assignment_id
-            WHERE s.submission_id=$1
-            """, sid
-        )
-        if not details:
-            raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
-
-        row = await conn.fetchrow(
-            """
-            UPDATE submissions
-            SET grade=$1, teacher_comment=$2, grade_date=NOW()
-            WHERE submission_id=$3
-            RETURNING submission_id, grade, teacher_comment, grade_date
-            """,
-            grade, comment, sid
-        )
+        # оценка и всё, что нужно боту для уведомления студента, — одним UPDATE ... FROM
+        row = await conn.fetchrow(GRADE_SUBMISSION_SQL, grade, comment, sid)
     if not row:
         raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
+    _invalidate_list_cache("submissions")
 
     # уведомим бота, чтобы он отослал студенту оценку
-    await enqueue_action("send_grade_to_student", {
-        "student_telegram_id": int(details["telegram_id"]) if details["telegram_id"] else None,
-        "assignment_id": int(details["assignment_id"]),
-        "assignment_title": details["title"],
+    enqueue_action("send_grade_to_student", {
+        "student_telegram_id": int(row["telegram_id"]) if row["telegram_id"] else None,
+        "assignment_id": int(row["assignment_id"]),
+        "assignment_title": row["title"],
         "submission_id": sid,
         "grade": row["grade"],
         "comment": row["teacher_comment"]
     })
 
-    resp = _jsonify_record(row)
-    resp["is_graded"] = True
-    return web.json_response(resp)
+    return json_response({
+        "submission_id": row["submission_id"],
+        "grade": row["grade"],
+        "teacher_comment": row["teacher_comment"],
+        "grade_date": row["grade_date"],
+        "is_graded": True,
+    })
 
 @admin_required
 async def resend_submission_to_admin(request: web.Request):
@@ -915,13 +1289,13 @@ async def resend_submission_to_admin(request: web.Request):
     file_type = _guess_type_from_file_id(sub["file_id"])
     caption = f"📎 Работа студента: {sub['last_name']} {sub['first_name']} (сдача ID: {sid})"
 
-    await enqueue_action("resend_submission_to_admin", {
+    enqueue_action("resend_submission_to_admin", {
         "admin_telegram_id": int(admin_tid),
         "file_id": sub["file_id"],
         "file_type": file_type,
         "caption": caption
     })
-    return web.json_response({"success": True})
+    return ok_response()
 
 # --------- Questions ----------
 
@@ -929,19 +1303,18 @@ async def resend_submission_to_admin(request: web.Request):
 async def questions_get(request: web.Request):
     q = request.query
     answered = (q.get("answered") or "all").lower()
-    
-    # === ИСПРАВЛЕНИЕ ЛОГИКИ ФИЛЬТРАЦИИ ===
-    where = ""
-    if answered == "false":
-        where = "WHERE q.answer_text IS NULL"
-    elif answered == "true":
-         where = "WHERE q.answer_text IS NOT NULL"
-    #
-    
+    # одна константная строка запроса на все фильтры: план готовится один раз на соединение
+    answered_flag = {"true": True, "false": False}.get(answered)
+
+    cache_key = ("questions", answered_flag)
+    cached = _list_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
         rows = await conn.fetch(
-            f"""
+            """
             SELECT q.question_id, q.student_id, q.group_id, q.question_text, q.asked_at,
                    q.answer_text, q.answered_by, q.answered_at,
                    u.first_name AS student_first_name, u.last_name AS student_last_name, u.telegram_id AS student_telegram_id,
@@ -951,11 +1324,23 @@ async def questions_get(request: web.Request):
             JOIN users u ON u.user_id = q.student_id
             LEFT JOIN groups g ON g.group_id = q.group_id
             LEFT JOIN users ab ON ab.user_id = q.answered_by
-            {where}
+            WHERE $1::bool IS NULL
+               OR ($1 AND q.answer_text IS NOT NULL)
+               OR (NOT $1 AND q.answer_text IS NULL)
             ORDER BY q.asked_at DESC
-            """
+            """,
+            answered_flag
         )
-    return web.json_response(_jsonify_records(rows))
+    return _list_cache_put(cache_key, rows)
+
+ANSWER_QUESTION_SQL = """
+    UPDATE questions q
+    SET answer_text=$1, answered_by=$2, answered_at=NOW()
+    FROM users u
+    WHERE q.question_id=$3 AND u.user_id = q.student_id
+    RETURNING q.question_id, q.student_id, q.question_text, q.answer_text, q.answered_at,
+              u.telegram_id AS student_telegram_id
+"""
 
 @admin_required
 async def answer_question(request: web.Request):
@@ -965,57 +1350,33 @@ async def answer_question(request: web.Request):
     """
     qid = int(request.match_info["question_id"])
     uid = request["admin_user_id"]
-    data = await request.json()
-    answer_text = (data.get("answer_text") or "").strip()
+    data = await request.json(loads=orjson.loads)
+    answer_text = _text_field(data, "answer_text") or ""
     if not answer_text:
         raise web.HTTPBadRequest(text='{"detail":"Missing answer_text"}', content_type="application/json")
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
         # гарантируем, что преподаватель есть в users (+teachers)
-        admin_user = await conn.fetchrow("SELECT user_id FROM users WHERE telegram_id = $1", uid)
-        if not admin_user:
-            admin_user = await conn.fetchrow(
-                """
-                INSERT INTO users (telegram_id, first_name, last_name, role, approved)
-                VALUES ($1, 'Admin', 'User', 'teacher', TRUE)
-                RETURNING user_id
-                """,
-                uid
-            )
-            await conn.execute(
-                "INSERT INTO teachers (teacher_id) VALUES ($1) ON CONFLICT DO NOTHING",
-                admin_user['user_id']
-            )
-        admin_user_id = admin_user['user_id']
+        admin_user_id = await _admin_db_user_id(conn, uid)
 
-        # Обновляем ответ и забираем необходимые поля
-        row = await conn.fetchrow(
-            """
-            UPDATE questions
-            SET answer_text=$1, answered_by=$2, answered_at=NOW()
-            WHERE question_id=$3
-            RETURNING question_id, student_id, question_text, answer_text, answered_at
-            """,
-            answer_text, admin_user_id, qid
-        )
+        # Обновляем ответ и тем же запросом забираем telegram_id студента
+        row = await conn.fetchrow(ANSWER_QUESTION_SQL, answer_text, admin_user_id, qid)
 
-        if not row:
-            raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
-
-        # Получаем telegram_id студента
-        st = await conn.fetchrow("SELECT telegram_id FROM users WHERE user_id=$1", row["student_id"])
-        student_tid = int(st["telegram_id"]) if st and st["telegram_id"] else None
+    if not row:
+        raise web.HTTPNotFound(text='{"detail":"Not found"}', content_type="application/json")
+    _invalidate_list_cache("questions")
+    student_tid = int(row["student_telegram_id"]) if row["student_telegram_id"] else None
 
     # Ставим задачу на отправку ответа студенту
     if student_tid:
-        await enqueue_action("notify_answer", {
+        enqueue_action("notify_answer", {
             "student_telegram_id": student_tid,
             "question_text": row["question_text"],
             "answer_text": row["answer_text"],
         })
 
-    return web.json_response(_jsonify_record(row))
+    return json_response(row)
 
 # --------- Broadcasts (универсальные рассылки преподавателя) ----------
 
@@ -1031,16 +1392,16 @@ async def send_broadcast(request: web.Request):
       "file_type": "document" | "photo" | null
     }
     """
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     try:
         group_id = int(data["group_id"])
     except Exception:
         raise web.HTTPBadRequest(text='{"detail":"Missing/invalid group_id"}', content_type="application/json")
 
-    title = (data.get("title") or "").strip() or None
-    text = (data.get("text") or "").strip() or ""
-    file_id = (data.get("file_id") or "").strip() or None
-    file_type = (data.get("file_type") or "").strip() or None
+    title = _text_field(data, "title")
+    text = _text_field(data, "text") or ""
+    file_id = _text_field(data, "file_id")
+    file_type = _text_field(data, "file_type")
     if not file_type and file_id:
         file_type = _guess_type_from_file_id(file_id)
 
@@ -1051,8 +1412,8 @@ async def send_broadcast(request: web.Request):
         "file_id": file_id,
         "file_type": file_type or "document"
     }
-    await enqueue_action("send_broadcast_to_group", payload)
-    return web.json_response({"success": True})
+    enqueue_action("send_broadcast_to_group", payload)
+    return ok_response()
 
 
 # =================================================================
@@ -1071,38 +1432,24 @@ async def materials_get(request: web.Request):
 
     category = (q.get("category") or "").strip() or None
 
-    pool: asyncpg.Pool = request.app["db_pool"]
-    async with pool.acquire() as conn:
-        base = """
-            SELECT
-                m.material_id,
-                m.group_id,
-                m.category,
-                m.title,
-                m.description,
-                m.created_at,
-                COALESCE(f.cnt, 0) AS files_count,
-                COALESCE(l.cnt, 0) AS links_count
-            FROM materials m
-            LEFT JOIN (
-                SELECT material_id, COUNT(*) AS cnt
-                FROM material_files
-                GROUP BY material_id
-            ) f ON f.material_id = m.material_id
-            LEFT JOIN (
-                SELECT material_id, COUNT(*) AS cnt
-                FROM material_links
-                GROUP BY material_id
-            ) l ON l.material_id = m.material_id
-            WHERE m.group_id = $1
-        """
-        args: List[Any] = [gid]
-        if category:
-            base += f" AND m.category = ${len(args)+1}"
-            args.append(category)
-        base += " ORDER BY m.material_id DESC"
-        rows = await conn.fetch(base, *args)
-    return web.json_response(_jsonify_records(rows))
+    # счётчики считаются только для материалов группы (index-only по idx_mfiles/idx_mlinks),
+    # а не GROUP BY по всем material_files/material_links на каждый запрос
+    query = """
+        SELECT
+            m.material_id,
+            m.group_id,
+            m.category,
+            m.title,
+            m.description,
+            m.created_at,
+            (SELECT COUNT(*) FROM material_files mf WHERE mf.material_id = m.material_id) AS files_count,
+            (SELECT COUNT(*) FROM material_links ml WHERE ml.material_id = m.material_id) AS links_count
+        FROM materials m
+        WHERE m.group_id = $1
+          AND ($2::text IS NULL OR m.category = $2)
+        ORDER BY m.material_id DESC
+    """
+    return await stream_json_rows(request, request.app["db_pool"], query, gid, category)
 
 
 @admin_required
@@ -1120,20 +1467,20 @@ async def send_material(request: web.Request):
       pin: bool
     }
     """
-    data = await request.json()
+    data = await request.json(loads=orjson.loads)
     admin_telegram_id = request.get("admin_user_id")
 
     try:
         group_id = int(data["group_id"])
-        category = (data.get("category") or "").strip()
-        title = (data.get("title") or "").strip()
+        category = _text_field(data, "category") or ""
+        title = _text_field(data, "title") or ""
     except (KeyError, ValueError, TypeError):
         raise web.HTTPBadRequest(text='{"detail":"Missing or invalid group_id/category/title"}', content_type="application/json")
 
     if not title:
         raise web.HTTPBadRequest(text='{"detail":"Title cannot be empty"}', content_type="application/json")
 
-    description = (data.get("description") or "").strip() or None
+    description = _text_field(data, "description")
     links = data.get("links") or []
     files = data.get("files") or []
     notify = bool(data.get("notify", True))
@@ -1141,27 +1488,9 @@ async def send_material(request: web.Request):
 
     pool: asyncpg.Pool = request.app["db_pool"]
     async with pool.acquire() as conn:
+        # убеждаемся, что админ есть в БД (как и в send_assignment) — до транзакции материала
+        admin_user_id = await _admin_db_user_id(conn, admin_telegram_id)
         async with conn.transaction():
-            # убеждаемся, что админ есть в БД (как и в send_assignment)
-            admin_user = await conn.fetchrow(
-                "SELECT user_id FROM users WHERE telegram_id = $1",
-                admin_telegram_id
-            )
-            if not admin_user:
-                admin_user = await conn.fetchrow(
-                    """
-                    INSERT INTO users (telegram_id, first_name, last_name, role, approved)
-                    VALUES ($1, 'Admin', 'User', 'teacher', TRUE)
-                    RETURNING user_id
-                    """,
-                    admin_telegram_id
-                )
-                await conn.execute(
-                    "INSERT INTO teachers (teacher_id) VALUES ($1) ON CONFLICT DO NOTHING",
-                    admin_user['user_id']
-                )
-            admin_user_id = admin_user['user_id']
-
             # создаём запись материала
             mat_row = await conn.fetchrow(
                 """
@@ -1173,36 +1502,40 @@ async def send_material(request: web.Request):
             )
             material_id = int(mat_row["material_id"])
 
-            # сохраняем файлы (если есть)
+            # сохраняем файлы (если есть) — как и ссылки, одним пакетом
+            file_rows = []
             for f in files:
-                fid = (f.get("file_id") or "").strip()
-                ftype = (f.get("file_type") or "").strip() or _guess_type_from_file_id(fid)
-                name = (f.get("name") or "").strip() or None
-                mime = (f.get("mime") or "").strip() or None
+                fid = _text_field(f, "file_id")
                 if not fid:
                     continue
-                await conn.execute(
+                file_rows.append((
+                    material_id,
+                    fid,
+                    _text_field(f, "file_type") or _guess_type_from_file_id(fid),
+                    _text_field(f, "name"),
+                    _text_field(f, "mime"),
+                ))
+            if file_rows:
+                await conn.executemany(
                     """
                     INSERT INTO material_files (material_id, file_id, file_type, name, mime)
                     VALUES ($1, $2, $3, $4, $5)
                     """,
-                    material_id, fid, ftype, name, mime
+                    file_rows
                 )
 
-            # сохраняем ссылки (если есть)
-            for url in links:
-                u = (url or "").strip()
-                if not u:
-                    continue
-                await conn.execute(
+            # сохраняем ссылки (если есть) — executemany шлёт весь пакет за один round-trip
+            link_rows = [(material_id, u) for u in ((url or "").strip() for url in links) if u]
+            if link_rows:
+                await conn.executemany(
                     "INSERT INTO material_links (material_id, url) VALUES ($1, $2)",
-                    material_id, u
+                    link_rows
                 )
 
     # нотификация бота (по аналогии с заданиями)
     if notify:
         try:
-            await enqueue_action("send_material_to_group", {
+            enqueue_action("send_material_to_group", {
                 "group_id": group_id,
                 "category": category,
                 "title": title,
@@ -1215,7 +1548,7 @@ async def send_material(request: web.Request):
         except Exception:
             logger.exception("Failed to enqueue material notification")
 
-    return web.json_response({"material_id": material_id, "success": True}, status=201)
+    return json_response({"material_id": material_id, "success": True}, status=201)
 
 # =================================================================
 # ===== КОНЕЦ ПЕРЕМЕЩЕННОГО БЛОКА =================================
@@ -1226,49 +1559,52 @@ async def send_material(request: web.Request):
 # Middlewares
 # -------------------------------------------------
 
+_INTERNAL_ERROR_BODY = orjson.dumps({"detail": "Internal Server Error"})
+
 @web.middleware
 async def error_middleware(request: web.Request, handler):
     try:
         return await handler(request)
     except web.HTTPException as e:
-        resp = web.json_response({"detail": str(e.text or e.reason)}, status=e.status)
-        resp.headers["Access-Control-Allow-Origin"] = "*"
-        resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, PATCH, OPTIONS"
-        resp.headers["Access-Control-Allow-Headers"] = "*"
-        return resp
+        if e.content_type == "application/json" and e.body:
+            # хендлеры бросают исключения с готовым '{"detail":...}' — отдаём тело как есть,
+            # а не сериализуем его ещё раз строкой внутрь нового {"detail": ...}
+            return web.Response(body=e.body, status=e.status, content_type="application/json")
+        return json_response({"detail": str(e.text or e.reason)}, status=e.status)
     except Exception:
         logger.exception("Unhandled error on %s %s", request.method, request.path)
-        resp = web.json_response({"detail": "Internal Server Error"}, status=500)
-        resp.headers["Access-Control-Allow-Origin"] = "*"
-        resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, PATCH, OPTIONS"
-        resp.headers["Access-Control-Allow-Headers"] = "*"
-        return resp
+        if request.get("response_started"):
+            # заголовки уже ушли: второй ответ в тот же поток не пишем — aiohttp закроет
+            # соединение без завершающего чанка, и клиент увидит оборванный ответ, а не «успешный»
+            raise
+        return web.Response(body=_INTERNAL_ERROR_BODY, status=500, content_type="application/json")
 
 @web.middleware
 async def cors_middleware(request: web.Request, handler):
     if request.method == "OPTIONS":
-        return web.Response(
-            status=200,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, PATCH, OPTIONS",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Max-Age": "3600",
-            }
-        )
-    response = await handler(request)
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, PATCH, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "*"
-    return response
+        # preflight без тела: 204 и заранее собранные заголовки
+        return web.Response(status=204, headers=_PREFLIGHT_HEADERS)
+    return await handler(request)
+
+async def _cors_headers(request: web.Request, response: web.StreamResponse):
+    # один хук на все ответы: обычные, ошибки из error_middleware, статика и StreamResponse,
+    # которые хендлер готовит сам (middleware после prepare дописать заголовки уже не может)
+    response.headers.update(CORS_HEADERS)
 
 # --------- Uploads ----------
 
+def _store_upload(tmp_path: str, dest_path: str) -> None:
+    """Переносит загруженный файл на место; если такое содержимое уже лежит — временный файл просто удаляется."""
+    if os.path.exists(dest_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, dest_path)
+
 @admin_required
 async def upload_file(request: web.Request):
     ctype = request.headers.get("Content-Type", "")
     if not ctype.startswith("multipart/form-data"):
-        return web.json_response({"detail": "Content-Type must be multipart/form-data"}, status=415)
+        return json_response({"detail": "Content-Type must be multipart/form-data"}, status=415)
 
     reader = await request.multipart()
     files_meta: List[Dict[str, Any]] = []
@@ -1280,27 +1616,39 @@ async def upload_file(request: web.Request):
                 break
 
             if not getattr(part, "filename", None):
-                await part.read(decode=False)
+                # не-файловые поля дочитываем без накопления в памяти
+                await part.release()
                 continue
 
             filename = _safe_filename(part.filename)
-            ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+            ext = _file_ext(filename)
             if ext not in ALLOWED_EXTS:
-                return web.json_response({"detail": f"File type .{ext} not allowed"}, status=400)
-
-            stored_name = f"{uuid.uuid4().hex}.{ext}" if ext else uuid.uuid4().hex
-            dest_path = os.path.join(UPLOAD_DIR, stored_name)
+                return json_response({"detail": f"File type .{ext} not allowed"}, status=400)
 
+            # пишем во временный файл и по ходу считаем sha256; имя итогового файла — хэш содержимого,
+            # так что повторная загрузка того же файла не занимает место второй раз
+            tmp_path = os.path.join(UPLOAD_DIR, f".{secrets.token_urlsafe(16)}.part")
+            digest = hashlib.sha256()
             size = 0
-            with open(dest_path, "wb") as f:
-                while True:
-                    chunk = await part.read_chunk()
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    size += len(chunk)
-
-            file_type, mime = _ext_type(filename)
+            try:
+                # запись на диск уходит в тред-пул aiofiles — event loop не блокируется
+                async with aiofiles.open(tmp_path, "wb") as f:
+                    while True:
+                        chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        await f.write(chunk)
+                        size += len(chunk)
+                stored_name = f"{digest.hexdigest()}.{ext}"
+                await asyncio.to_thread(_store_upload, tmp_path, os.path.join(UPLOAD_DIR, stored_name))
+            except BaseException:
+                # оборванная загрузка не должна оставлять недописанный файл в UPLOAD_DIR
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                raise
+
+            file_type, mime = _ext_type(ext)
             files_meta.append({
                 "file_id": f"local:{stored_name}",
                 "file_type": file_type,
@@ -1312,10 +1660,10 @@ async def upload_file(request: web.Request):
 
     except Exception:
         logger.exception("Upload parse error")
-        return web.json_response({"detail": "Bad upload"}, status=400)
+        return json_response({"detail": "Bad upload"}, status=400)
 
     if not files_meta:
-        return web.json_response({"detail": "No file"}, status=400)
+        return json_response({"detail": "No file"}, status=400)
 
     resp: Dict[str, Any] = {"files": files_meta}
     if len(files_meta) == 1:
@@ -1323,15 +1671,17 @@ async def upload_file(request: web.Request):
             "file_id": files_meta[0]["file_id"],
             "file_type": files_meta[0]["file_type"]
         })
-    return web.json_response(resp)
+    return json_response(resp)
 
 # -------------------------------------------------
 # App wiring
 # -------------------------------------------------
 
 def make_app() -> web.Application:
-    app = web.Application(middlewares=[cors_middleware, error_middleware])
+    app = web.Application(middlewares=[cors_middleware, error_middleware, admin_middleware])
     app.cleanup_ctx.append(create_pool)
+    app.cleanup_ctx.append(bot_queue_ctx)
+    app.on_startup.append(load_webapp)
 
     # Routes
     app.router.add_get("/health", health_handler)
@@ -1343,6 +1693,7 @@ def make_app() -> web.Application:
     app.router.add_delete("/api/groups/{group_id}", group_delete)
 
     app.router.add_get("/api/users", users_get)
+    app.router.add_patch("/api/users/approve", users_approve_bulk)
     app.router.add_patch("/api/users/{user_id}/approve", user_approve)
     app.router.add_patch("/api/users/{user_id}/role", user_role)
     app.router.add_patch("/api/users/{user_id}/group", user_group)
@@ -1352,6 +1703,7 @@ def make_app() -> web.Application:
     app.router.add_post("/api/group_changes/{user_id}/reject", reject_group_change)
 
     app.router.add_get("/api/name_changes/pending", pending_name_changes_get)
+    app.router.add_get("/api/admin/overview", admin_overview)
     app.router.add_post("/api/name_changes/{user_id}/approve", approve_name_change)
     app.router.add_post("/api/name_changes/{user_id}/reject", reject_name_change)
 
@@ -1376,6 +1728,7 @@ def make_app() -> web.Application:
     app.router.add_post("/api/broadcasts/send", send_broadcast)
 
     app.router.add_post("/api/upload_file", upload_file)
+    app.on_response_prepare.append(_cors_headers)
     
     # Материалы — функции определены выше (исправление порядка)
     app.router.add_get("/api/materials", materials_get)
@@ -1391,11 +1744,23 @@ async def main_backend():
     site = web.TCPSite(runner, "0.0.0.0", 8080)
     logger.info("Backend running on 0.0.0.0:8080")
     await site.start()
+    loop = asyncio.get_running_loop()
+    logger.info("Event loop: %s", type(loop).__name__)
+
+    # ждём сигнала остановки без периодических пробуждений; по нему корректно гасим runner:
+    # текущие запросы (в т.ч. загрузки) дорабатывают, cleanup_ctx дописывает очередь бота
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError):  # Windows: add_signal_handler нет
+            loop.add_signal_handler(sig, stop.set)
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except (KeyboardInterrupt, SystemExit):
+        await stop.wait()
+    finally:
         logger.info("Shutting down backend")
+        await runner.cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main_backend())
+    # loop_factory вместо глобальной политики (uvloop.install() объявлен устаревшим);
+    # asyncio.run(loop_factory=...) есть только с 3.12, а Runner — с 3.11, как в Dockerfile
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop is not None else None) as runner:
+        runner.run(main_backend())
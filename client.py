@@ -1,13 +1,19 @@
 import asyncio
-import json
+import atexit
+import functools
 import logging
+import logging.handlers
 import os
+import queue
+import time
 import uuid
+from collections import OrderedDict
 from contextlib import suppress
 from datetime import datetime
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
 
 import asyncpg
+import orjson
 from aiogram import Bot, Dispatcher, F, Router, html, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ContentType, ParseMode
@@ -20,6 +26,7 @@ from aiogram.dispatcher.middlewares.base import BaseMiddleware
 from aiogram.types import (
     CallbackQuery,
     ChatMemberUpdated,
+    FSInputFile,
     InlineKeyboardMarkup,
     Message,
     ReplyKeyboardMarkup,
@@ -31,15 +38,43 @@ from aiogram.types import (
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from dotenv import load_dotenv
 
+try:
+    import fcntl  # flock очереди для бота; на Windows модуля нет — пишем/читаем без блокировки
+except ImportError:
+    fcntl = None
+
+try:
+    import uvloop  # быстрый event loop; в локальной разработке (Windows) его может не быть
+except ImportError:
+    uvloop = None
+
 import api
 
 # -------------------- ENV / LOGGING --------------------
 load_dotenv()
 
+# Хендлеры только кладут запись в очередь, а в stdout пишет отдельный поток:
+# всплеск ошибок не блокирует event loop на записи в консоль.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+
 BOT_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 WEBAPP_URL = os.getenv("WEBAPP_URL")
+BOT_QUEUE_FILE = os.getenv("BOT_QUEUE_FILE", "/tmp/bot_queue.jsonl")
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")  # общий с backend.py (один контейнер)
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")
+# свои имена переменных: backend в том же контейнере читает DB_POOL_MIN/DB_POOL_MAX
+BOT_DB_POOL_MIN = int(os.getenv("BOT_DB_POOL_MIN", "5"))
+BOT_DB_POOL_MAX = int(os.getenv("BOT_DB_POOL_MAX", "20"))
 ADMIN_IDS: Set[int] = set()
 if ADMIN_IDS_STR:
     try:
@@ -50,14 +85,9 @@ if ADMIN_IDS_STR:
 else:
     logging.warning("ADMIN_IDS не указаны.")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-)
-logger = logging.getLogger(__name__)
-
 # -------------------- Константы --------------------
-ALLOWED_DOC_EXTS = {"pptx", "pdf", "docx"}
+ALLOWED_DOC_EXTS = frozenset({"pptx", "pdf", "docx"})
+ALLOWED_DOC_EXTS_TEXT = ", ".join("." + ext for ext in sorted(ALLOWED_DOC_EXTS))
 
 MATERIAL_CATEGORIES = {
     "lectures": "Лекции",
@@ -67,6 +97,15 @@ MATERIAL_CATEGORIES = {
     "links": "Ссылки",
     "library": "Библиотека",
 }
+# текст кнопки меню материалов -> ключ категории; строится один раз, а не на каждое сообщение
+MATERIAL_BUTTON_TO_KEY = {
+    "📘 Лекции": "lectures",
+    "📣 Объявления": "announcements",
+    "📊 Графики/Рисунки": "figures",
+    "🎬 Видео": "video",
+    "🔗 Ссылки": "links",
+    "📚 Библиотека": "library",
+}
 
 # -------------------- FSM --------------------
 class Registration(StatesGroup):
@@ -95,9 +134,18 @@ materials_router = Router()
 db_pool: Optional[asyncpg.Pool] = None
 bot_instance: Optional[Bot] = None
 
-LAST_MATERIALS: Dict[int, List[str]] = {}
+# последние материалы по tg_id; словари — LRU: процесс живёт долго, а записи появляются
+# на каждого студента, получившего рассылку, поэтому самых давних вытесняем
+LAST_MATERIALS: "OrderedDict[int, List[str]]" = OrderedDict()
 MAX_LAST_MATERIALS = 5
-LAST_MATERIALS_BY_CAT: Dict[int, Dict[str, List[str]]] = {}
+LAST_MATERIALS_BY_CAT: "OrderedDict[int, Dict[str, List[str]]]" = OrderedDict()
+LAST_MATERIALS_MAX_USERS = 10_000
+
+# Рассылки по группе: не больше BROADCAST_CONCURRENCY отправок одновременно,
+# каждая занимает слот ~1 с — итоговый темп укладывается в лимит Telegram (30 сообщений/с).
+BROADCAST_CONCURRENCY = 25
+_broadcast_semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+_background_tasks: Set[asyncio.Task] = set()
 
 # -------------------- DB --------------------
 async def get_db_pool() -> asyncpg.Pool:
@@ -107,7 +155,19 @@ async def get_db_pool() -> asyncpg.Pool:
             db_url = DATABASE_URL
             if db_url and db_url.startswith("postgres://"):
                 db_url = db_url.replace("postgres://", "postgresql://", 1)
-            db_pool = await asyncpg.create_pool(db_url, max_size=20)
+            # все запросы api.py — константные строки (их пара десятков), поэтому подготовленные
+            # выражения держим без срока жизни: по умолчанию asyncpg выкидывает их каждые 5 минут
+            db_pool = await asyncpg.create_pool(
+                db_url,
+                # min_size соединений открываются сразу — первый /start после старта не ждёт connect
+                min_size=BOT_DB_POOL_MIN,
+                max_size=BOT_DB_POOL_MAX,
+                max_inactive_connection_lifetime=300,
+                command_timeout=30,
+                statement_cache_size=512,
+                max_cached_statement_lifetime=0,
+                server_settings={"application_name": "vsilant-bot", "jit": "off"},
+            )
             logger.info("Пул БД создан")
         except Exception as e:
             logger.critical(f"Ошибка пула БД: {e}", exc_info=True)
@@ -115,14 +175,53 @@ async def get_db_pool() -> asyncpg.Pool:
     return db_pool
 
 
+# -------------------- User cache --------------------
+# ApprovalMiddleware читает пользователя на каждый апдейт. Запись держим недолго: одобрение, роль
+# и группу меняет backend (другой процесс), поэтому кроме явного сброса есть короткий TTL
+USER_CACHE_TTL = 15.0  # секунд
+USER_CACHE_MAX = 10_000
+_user_cache: "OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+
+
+async def _get_user_cached(pool: asyncpg.Pool, telegram_id: int) -> Optional[Dict[str, Any]]:
+    now = time.monotonic()
+    cached = _user_cache.get(telegram_id)
+    if cached and cached[0] > now:
+        _user_cache.move_to_end(telegram_id)
+        return cached[1]
+    async with pool.acquire() as conn:
+        db_user = await api.get_user(conn, telegram_id)
+    # LRU, как у LAST_MATERIALS: при переполнении вытесняем самого давнего, а не весь кэш разом
+    _user_cache.pop(telegram_id, None)
+    while len(_user_cache) >= USER_CACHE_MAX:
+        _user_cache.popitem(last=False)
+    _user_cache[telegram_id] = (now + USER_CACHE_TTL, db_user)
+    return db_user
+
+
+def _invalidate_user(telegram_id: int) -> None:
+    _user_cache.pop(telegram_id, None)
+
+
 # -------------------- Menu Button --------------------
-async def apply_menu_button(bot: Bot, user_id: int, is_admin: bool):
+# последнее применённое меню по tg_id: middleware зовёт apply_menu_button на каждом апдейте,
+# а повторный set_chat_menu_button — лишний запрос к Bot API с тем же результатом
+_menu_applied: "OrderedDict[int, bool]" = OrderedDict()
+
+
+async def apply_menu_button(bot: Bot, user_id: int, is_admin: bool, force: bool = False):
+    if not force and _menu_applied.get(user_id) is is_admin:
+        return
     try:
         if is_admin and WEBAPP_URL:
             mb = types.MenuButtonWebApp(text="Админ-панель", web_app=WebAppInfo(url=WEBAPP_URL))
         else:
             mb = types.MenuButtonDefault()
         await bot.set_chat_menu_button(chat_id=user_id, menu_button=mb)
+        _menu_applied.pop(user_id, None)
+        while len(_menu_applied) >= USER_CACHE_MAX:
+            _menu_applied.popitem(last=False)
+        _menu_applied[user_id] = is_admin
     except Exception as e:
         logger.warning(f"Не удалось применить меню для {user_id}: {e}")
 
@@ -200,8 +299,7 @@ class ApprovalMiddleware(BaseMiddleware):
         # Ищем пользователя в БД
         db_user = None
         try:
-            async with pool.acquire() as conn:
-                db_user = await api.get_user(conn, user.id)
+            db_user = await _get_user_cached(pool, user.id)
         except Exception as e:
             logger.error(f"DB error in middleware getting user {user.id}: {e}")
 
@@ -246,6 +344,9 @@ class ApprovalMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 # -------------------- Keyboards --------------------
+# статичные клавиатуры собираются один раз: билдер + валидация pydantic-моделей на каждый
+# ответ не нужны, а готовую разметку aiogram только сериализует, так что делить её безопасно
+@functools.lru_cache(maxsize=1)
 def get_student_main_keyboard() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.button(text="📝 Сдать задание")
@@ -257,6 +358,7 @@ def get_student_main_keyboard() -> ReplyKeyboardMarkup:
     return builder.as_markup(resize_keyboard=True, input_field_placeholder="Действие:")
 
 
+@functools.lru_cache(maxsize=1)
 def get_admin_main_keyboard() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.button(text="📝 Сдать задание")
@@ -270,6 +372,7 @@ def get_admin_main_keyboard() -> ReplyKeyboardMarkup:
     return builder.as_markup(resize_keyboard=True, input_field_placeholder="Админ / Действие:")
 
 
+@functools.lru_cache(maxsize=1)
 def get_profile_menu_keyboard() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.button(text="🔄 Сменить группу")
@@ -279,6 +382,7 @@ def get_profile_menu_keyboard() -> ReplyKeyboardMarkup:
     return builder.as_markup(resize_keyboard=True, input_field_placeholder="Профиль:")
 
 
+@functools.lru_cache(maxsize=1)
 def get_materials_menu_keyboard() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.button(text="📘 Лекции")
@@ -321,7 +425,7 @@ async def handle_start(message: Message, state: FSMContext, db_pool: asyncpg.Poo
     last_name_tg = user.last_name or ""
     is_admin = user_id in ADMIN_IDS
 
-    await apply_menu_button(message.bot, user_id, is_admin)
+    await apply_menu_button(message.bot, user_id, is_admin, force=True)
 
     # строгая проверка нужды регистрации
     def needs_registration(u: Optional[dict]) -> bool:
@@ -339,6 +443,8 @@ async def handle_start(message: Message, state: FSMContext, db_pool: asyncpg.Poo
         # причём даже если approved=False — сначала рега
         return (role != "student") or (not g_ok) or (not has_names)
 
+    # /start всегда читает БД заново (после одобрения пользователю так и советуют) — сбрасываем и кэш
+    _invalidate_user(user_id)
     db_user = None
     try:
         async with db_pool.acquire() as conn:
@@ -408,7 +514,7 @@ async def on_my_chat_member(update: ChatMemberUpdated, bot: Bot):
     if not user:
         return
     is_admin = user.id in ADMIN_IDS
-    await apply_menu_button(bot, user.id, is_admin)
+    await apply_menu_button(bot, user.id, is_admin, force=True)
 
 
 @main_router.message(Command("menu"))
@@ -505,48 +611,9 @@ async def reg_choosing_group_callback(query: CallbackQuery, state: FSMContext, d
 
     try:
         async with db_pool.acquire() as conn:
-            db_user = await api.get_user(conn, user.id)
-
-            if not db_user:
-                # Полный новый
-                user_data = {
-                    "telegram_id": user.id,
-                    "username": user.username,
-                    "first_name": first_name,
-                    "last_name": last_name,
-                }
-                new_user = await api.add_user(conn, user_data)
-                user_db_id = new_user["user_id"]
-                await api.set_user_role(conn, user_db_id, "student")
-                await api.add_student(conn, user_db_id, group_id)
-                await api.set_student_group(conn, user_db_id, group_id)
-            else:
-                user_db_id = db_user["user_id"]
-                # Обновим имя/фамилию если пустые
-                try:
-                    if not db_user.get("first_name") or not db_user.get("last_name"):
-                        await conn.execute(
-                            "UPDATE users SET first_name=$1, last_name=$2 WHERE user_id=$3",
-                            first_name, last_name, user_db_id
-                        )
-                except Exception as e:
-                    logger.debug(f"Skip update names: {e}")
-
-                # Роль student
-                try:
-                    await api.set_user_role(conn, user_db_id, "student")
-                except Exception:
-                    pass
-
-                # students + группа
-                try:
-                    await api.add_student(conn, user_db_id, group_id)
-                except Exception:
-                    pass
-                try:
-                    await api.set_student_group(conn, user_db_id, group_id)
-                except Exception as e:
-                    logger.warning(f"set_student_group failed for {user_db_id}: {e}")
+            # users + роль + students/группа — одним выражением, вместо 4 round-trip'ов
+            await api.register_student(conn, user.id, user.username, first_name, last_name, group_id)
+        _invalidate_user(user.id)
 
         await query.message.edit_text(
             "✅ <b>Регистрация завершена!</b>\n\n"
@@ -690,8 +757,19 @@ async def student_view_assignment(
         return
 
     try:
+        user_db_id = user_info.get("user_id")
+        sub = None
+        # задание и своя сдача — на одном соединении, без второго захвата из пула
         async with db_pool.acquire() as conn:
             a = await api.get_assignment(conn, assignment_id)
+            if a and user_role == "student" and user_db_id:
+                try:
+                    sub = await conn.fetchrow(
+                        "SELECT submission_date, is_late, grade FROM submissions WHERE assignment_id=$1 AND student_id=$2",
+                        assignment_id, user_db_id
+                    )
+                except Exception as e:
+                    logger.error(f"Error checking submission status: {e}")
         if not a:
             await query.answer("Задание не найдено", show_alert=True)
             return
@@ -720,21 +798,11 @@ async def student_view_assignment(
         text += f"📬 Прием работ: {status_text}\n"
 
         submission_info = ""
-        user_db_id = user_info.get("user_id")
-        if user_role == "student" and user_db_id:
-            try:
-                async with db_pool.acquire() as conn:
-                    sub = await conn.fetchrow(
-                        "SELECT submission_date, is_late, grade FROM submissions WHERE assignment_id=$1 AND student_id=$2",
-                        assignment_id, user_db_id
-                    )
-                    if sub:
-                        sub_time = sub['submission_date'].strftime("%d.%m.%Y %H:%M")
-                        late_mark = " (с опозданием)" if sub['is_late'] else ""
-                        grade_mark = f", Оценка: {sub['grade']}/20" if sub['grade'] is not None else ", ещё не оценено"
-                        submission_info = f"\n\n✅ <b>Вы сдали {sub_time}{late_mark}{grade_mark}.</b> Можно пересдать."
-            except Exception as e:
-                logger.error(f"Error checking submission status: {e}")
+        if sub:
+            sub_time = sub['submission_date'].strftime("%d.%m.%Y %H:%M")
+            late_mark = " (с опозданием)" if sub['is_late'] else ""
+            grade_mark = f", Оценка: {sub['grade']}/20" if sub['grade'] is not None else ", ещё не оценено"
+            submission_info = f"\n\n✅ <b>Вы сдали {sub_time}{late_mark}{grade_mark}.</b> Можно пересдать."
         text += submission_info
 
         builder = InlineKeyboardBuilder()
@@ -794,7 +862,7 @@ async def student_submit_now_start(
     if query.message:
         await query.message.edit_text(
             f"📎 Отправьте <b>один документ</b> с решением.\n"
-            f"Допустимые форматы: <b>{', '.join('.' + ext for ext in ALLOWED_DOC_EXTS)}</b>.\n\n"
+            f"Допустимые форматы: <b>{ALLOWED_DOC_EXTS_TEXT}</b>.\n\n"
             f"📝 Задание: <b>{html.quote(title)}</b>\n\n"
             f"<i>(Если передумали, отправьте /cancel)</i>",
             parse_mode=ParseMode.HTML,
@@ -844,16 +912,17 @@ async def student_submit_assignment_file(
 
     if not message.document:
         await message.reply(
-            f"❌ Отправьте <b>документ</b> в формате <b>{', '.join('.' + ext for ext in ALLOWED_DOC_EXTS)}</b>.",
+            f"❌ Отправьте <b>документ</b> в формате <b>{ALLOWED_DOC_EXTS_TEXT}</b>.",
             parse_mode=ParseMode.HTML,
         )
         return
 
-    file_name = (message.document.file_name or "file").lower()
-    ext = file_name.rsplit(".", 1)[-1] if "." in file_name else ""
+    # в нижний регистр приводим только расширение, а не всё имя файла
+    _, dot, ext = (message.document.file_name or "").rpartition(".")
+    ext = ext.lower() if dot else ""
     if ext not in ALLOWED_DOC_EXTS:
         await message.reply(
-            f"❌ Недопустимый формат (.{ext}). Разрешены: <b>{', '.join('.' + ext for ext in ALLOWED_DOC_EXTS)}</b>.",
+            f"❌ Недопустимый формат (.{ext}). Разрешены: <b>{ALLOWED_DOC_EXTS_TEXT}</b>.",
             parse_mode=ParseMode.HTML,
         )
         return
@@ -868,11 +937,18 @@ async def student_submit_assignment_file(
                 await state.clear()
                 return
 
-        await message.answer("✅ Решение отправлено!", reply_markup=kbd)
-        await state.clear()
+        # список преподавателей нужен только для уведомления — запрос к БД идёт, пока уходит ответ студенту
+        teachers_task = asyncio.create_task(api.get_teachers_ids(db_pool))
+        try:
+            await message.answer("✅ Решение отправлено!", reply_markup=kbd)
+            await state.clear()
+        except BaseException:
+            # до await задачи не дошли — отменяем её, а не оставляем висеть с неполученной ошибкой
+            teachers_task.cancel()
+            raise
 
         try:
-            teachers_db_ids = await api.get_teachers_ids(db_pool)
+            teachers_db_ids = await teachers_task
             all_notify_ids = set(teachers_db_ids) | ADMIN_IDS
 
             submitter_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip() or f"ID: {submitter_db_id}"
@@ -896,16 +972,12 @@ async def student_submit_assignment_file(
                 f"🆔 ID сдачи: <code>{submission_id}</code>"
             )
 
-            sent_to = set()
-            for tid in all_notify_ids:
-                if tid == message.from_user.id or tid in sent_to:
-                    continue
-                try:
-                    await bot.send_document(chat_id=tid, document=file_id, caption=caption, parse_mode=ParseMode.HTML)
-                    sent_to.add(tid)
-                    await asyncio.sleep(0.05)
-                except TelegramAPIError as e:
-                    logger.error(f"Notify {tid} about submission {submission_id} fail: {e}")
+            all_notify_ids.discard(message.from_user.id)
+            await _notify_staff(
+                all_notify_ids,
+                lambda tid: bot.send_document(chat_id=tid, document=file_id, caption=caption, parse_mode=ParseMode.HTML),
+                f"submission {submission_id}",
+            )
         except Exception as e:
             logger.error(f"Error during notify phase: {e}", exc_info=True)
 
@@ -925,7 +997,7 @@ async def student_submit_assignment_file(
 @student_router.message(StudentActions.submitting_assignment_file)
 async def student_submit_assignment_incorrect_type(message: Message):
     await message.reply(
-        f"❌ Ожидается файл-документ. Отправьте один из форматов: <b>{', '.join('.' + ext for ext in ALLOWED_DOC_EXTS)}</b> или /cancel.",
+        f"❌ Ожидается файл-документ. Отправьте один из форматов: <b>{ALLOWED_DOC_EXTS_TEXT}</b> или /cancel.",
         parse_mode=ParseMode.HTML
     )
 
@@ -982,11 +1054,17 @@ async def process_question(
         if not q_res or "question_id" not in q_res:
             raise Exception("Failed to add question to DB or missing question_id")
 
-        await message.answer("✅ Ваш вопрос отправлен преподавателям и администраторам.", reply_markup=kbd)
-        await state.clear()
+        teachers_task = asyncio.create_task(api.get_teachers_ids(db_pool))
+        try:
+            await message.answer("✅ Ваш вопрос отправлен преподавателям и администраторам.", reply_markup=kbd)
+            await state.clear()
+        except BaseException:
+            # до await задачи не дошли — отменяем её, а не оставляем висеть с неполученной ошибкой
+            teachers_task.cancel()
+            raise
 
         try:
-            teachers_db_ids = await api.get_teachers_ids(db_pool)
+            teachers_db_ids = await teachers_task
             all_notify_ids = set(teachers_db_ids) | ADMIN_IDS
 
             submitter_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip() or f"ID: {submitter_db_id}"
@@ -999,16 +1077,12 @@ async def process_question(
                 f"<i>{html.quote(q_text)}</i>"
             )
 
-            sent_to = set()
-            for tid in all_notify_ids:
-                if tid == message.from_user.id or tid in sent_to:
-                    continue
-                try:
-                    await bot.send_message(tid, notify_text, parse_mode=ParseMode.HTML)
-                    sent_to.add(tid)
-                    await asyncio.sleep(0.05)
-                except TelegramAPIError as e:
-                    logger.error(f"Notify teacher/admin {tid} about question {q_id} fail: {e}")
+            all_notify_ids.discard(message.from_user.id)
+            await _notify_staff(
+                all_notify_ids,
+                lambda tid: bot.send_message(tid, notify_text, parse_mode=ParseMode.HTML),
+                f"question {q_id}",
+            )
         except Exception as e:
             logger.error(f"Error during Q&A notification phase: {e}", exc_info=True)
 
@@ -1136,6 +1210,7 @@ async def process_group_change_request(query: CallbackQuery, state: FSMContext,
                 group_name = f"группу «{new_group['name']}»"
             success = await api.request_group_change(conn, user_db_id, new_group_id)
             if success:
+                _invalidate_user(query.from_user.id)
                 await query.message.edit_text(
                     f"✅ Ваш запрос на переход в <b>{html.quote(group_name)}</b> отправлен администратору.",
                     parse_mode=ParseMode.HTML
@@ -1239,6 +1314,7 @@ async def process_change_name_last(message: Message, state: FSMContext, user_db_
         async with db_pool.acquire() as conn:
             success = await api.request_name_change(conn, user_db_id, first_name, last_name)
         if success:
+            _invalidate_user(message.from_user.id)
             await message.answer(
                 f"✅ Запрос на смену имени на <b>{html.quote(first_name)} {html.quote(last_name)}</b> отправлен администратору.",
                 reply_markup=kbd,
@@ -1260,10 +1336,9 @@ async def open_materials_menu(message: Message, user_role: str):
         await message.answer("Выберите раздел материалов:", reply_markup=get_materials_menu_keyboard())
 
 
-@materials_router.message(F.text.in_({"📘 Лекции", "📣 Объявления", "📊 Графики/Рисунки", "🎬 Видео", "🔗 Ссылки", "📚 Библиотека"}))
+@materials_router.message(F.text.in_(frozenset(MATERIAL_BUTTON_TO_KEY)))
 async def show_materials_by_category(message: Message):
-    title_to_key = {v: k for k, v in MATERIAL_CATEGORIES.items()}
-    category_key = title_to_key.get(message.text)
+    category_key = MATERIAL_BUTTON_TO_KEY.get(message.text)
     if not category_key:
         await message.reply("Неизвестная категория.")
         return
@@ -1284,6 +1359,14 @@ async def show_materials_by_category(message: Message):
 
 
 # -------------------- Очередь действий от backend --------------------
+@functools.lru_cache(maxsize=8)
+def _approval_markup(button_text: str) -> InlineKeyboardMarkup:
+    """Кнопка «Открыть меню» одинакова для всех одобренных — при массовом одобрении строим её один раз."""
+    builder = InlineKeyboardBuilder()
+    builder.button(text=button_text, callback_data="open_menu")
+    return builder.as_markup()
+
+
 def _fmt_grade_message(title: str, grade: Optional[int], comment: Optional[str]) -> str:
     txt = f"✅ <b>Оценка за «{html.quote(title or 'Задание')}»</b>\n\n"
     grade_str = f"<b>{grade}/20</b>" if grade is not None else "<i>Без оценки</i>"
@@ -1294,8 +1377,20 @@ def _fmt_grade_message(title: str, grade: Optional[int], comment: Optional[str])
     return txt
 
 
+def _lru_slot(storage: OrderedDict, telegram_id: int, factory: Callable[[], Any]) -> Any:
+    """Значение пользователя из LRU-словаря (создаёт при отсутствии, вытесняя самого давнего)."""
+    value = storage.get(telegram_id)
+    if value is None:
+        if len(storage) >= LAST_MATERIALS_MAX_USERS:
+            storage.popitem(last=False)
+        value = storage[telegram_id] = factory()
+    else:
+        storage.move_to_end(telegram_id)
+    return value
+
+
 def _remember_material(telegram_id: int, summary: str):
-    arr = LAST_MATERIALS.setdefault(telegram_id, [])
+    arr = _lru_slot(LAST_MATERIALS, telegram_id, list)
     if not arr or arr[-1] != summary:
         arr.append(summary)
     if len(arr) > MAX_LAST_MATERIALS:
@@ -1303,7 +1398,7 @@ def _remember_material(telegram_id: int, summary: str):
 
 
 def _remember_material_by_cat(telegram_id: int, category: str, summary: str):
-    cat_map = LAST_MATERIALS_BY_CAT.setdefault(telegram_id, {})
+    cat_map = _lru_slot(LAST_MATERIALS_BY_CAT, telegram_id, dict)
     arr = cat_map.setdefault(category, [])
     if not arr or arr[-1] != summary:
         arr.append(summary)
@@ -1311,6 +1406,53 @@ def _remember_material_by_cat(telegram_id: int, category: str, summary: str):
         del arr[0: len(arr) - MAX_LAST_MATERIALS]
 
 
+MAX_CAPTION = 1024
+MAX_TEXT = 4096
+
+# (file_id или файл с диска, подпись, куски текста) — всё, что не зависит от получателя
+Outgoing = Tuple[Optional[Union[str, FSInputFile]], str, List[str]]
+
+# путь загруженного через админку файла -> file_id, который Telegram выдал при первой отправке:
+# файл с диска уходит в Telegram один раз, дальше шлём по file_id
+# LRU, как у LAST_MATERIALS: запись появляется на каждый загруженный файл
+LOCAL_FILE_IDS_MAX = 10_000
+_local_file_ids: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _resolve_local_file(file_id: str) -> Optional[Union[str, FSInputFile]]:
+    """'local:<stored_name>' → file_id из кэша или FSInputFile (aiogram читает файл с диска кусками)."""
+    path = os.path.join(UPLOAD_DIR, os.path.basename(file_id.split(":", 1)[1]))
+    cached = _local_file_ids.get(path)
+    if cached:
+        _local_file_ids.move_to_end(path)
+        return cached
+    if not os.path.isfile(path):
+        logger.warning(f"Local file {file_id} not found in {UPLOAD_DIR}. Sending text only.")
+        return None
+    return FSInputFile(path)
+
+
+def _message_file_id(message: Message) -> Optional[str]:
+    if message.photo:
+        return message.photo[-1].file_id
+    media = message.video or message.document
+    return media.file_id if media else None
+
+
+def _prepare_outgoing(text: Optional[str], file_id: Optional[str]) -> Outgoing:
+    """Нормализует сообщение перед отправкой. При рассылке считается один раз на всех получателей."""
+    if file_id and file_id.startswith("local:"):
+        file_id = _resolve_local_file(file_id)
+
+    caption = text or ""
+    if len(caption) > MAX_CAPTION:
+        caption = caption[:MAX_CAPTION - 3] + "..."
+        logger.warning(f"Caption truncated for file {file_id}")
+
+    chunks = [text[i: i + MAX_TEXT] for i in range(0, len(text), MAX_TEXT)] if text else []
+    return file_id, caption, chunks
+
+
 async def _send_and_pin(
     bot: Bot,
     chat_id: int,
@@ -1319,19 +1461,12 @@ async def _send_and_pin(
     file_type: Optional[str] = None,
     parse_mode: Optional[ParseMode] = ParseMode.HTML,
     disable_notification: bool = False,
-    pin_message: bool = True
+    pin_message: bool = True,
+    prepared: Optional[Outgoing] = None,
 ) -> Optional[int]:
     sent_message: Optional[Message] = None
     try:
-        if file_id and file_id.startswith("local:"):
-            logger.warning(f"Cannot send local file {file_id}. Sending text only for chat {chat_id}.")
-            file_id = None
-
-        MAX_CAPTION = 1024
-        caption = text or ""
-        if len(caption) > MAX_CAPTION:
-            caption = caption[:MAX_CAPTION - 3] + "..."
-            logger.warning(f"Caption truncated for chat {chat_id}, file {file_id}")
+        file_id, caption, chunks = prepared or _prepare_outgoing(text, file_id)
 
         if file_id:
             effective_type = file_type or "document"
@@ -1342,26 +1477,32 @@ async def _send_and_pin(
                     sent_message = await bot.send_video(chat_id, file_id, caption=caption, parse_mode=parse_mode)
                 else:
                     sent_message = await bot.send_document(chat_id, file_id, caption=caption, parse_mode=parse_mode)
+                if isinstance(file_id, FSInputFile) and sent_message:
+                    uploaded_id = _message_file_id(sent_message)
+                    if uploaded_id:
+                        _local_file_ids.pop(file_id.path, None)
+                        while len(_local_file_ids) >= LOCAL_FILE_IDS_MAX:
+                            _local_file_ids.popitem(last=False)
+                        _local_file_ids[file_id.path] = uploaded_id
             except TelegramAPIError as send_error:
                 logger.error(f"Failed to send file {file_id} ({effective_type}) to {chat_id}: {send_error}")
-                if text:
+                if chunks:
                     logger.info(f"Falling back to sending text only to {chat_id}")
                 else:
                     return None
 
-        if text and not sent_message:
-            MAX_TEXT = 4096
-            if len(text) <= MAX_TEXT:
+        if chunks and not sent_message:
+            if len(chunks) == 1:
                 try:
-                    sent_message = await bot.send_message(chat_id, text, parse_mode=parse_mode)
+                    sent_message = await bot.send_message(chat_id, chunks[0], parse_mode=parse_mode)
                 except TelegramAPIError as text_error:
                     logger.error(f"Failed to send text message to {chat_id}: {text_error}")
                     return None
             else:
                 pin_message = False
                 try:
-                    for i in range(0, len(text), MAX_TEXT):
-                        await bot.send_message(chat_id, text[i: i + MAX_TEXT], parse_mode=parse_mode)
+                    for chunk in chunks:
+                        await bot.send_message(chat_id, chunk, parse_mode=parse_mode)
                         await asyncio.sleep(0.1)
                     return None
                 except TelegramAPIError as chunk_error:
@@ -1381,35 +1522,131 @@ async def _send_and_pin(
         return None
 
 
+async def _broadcast_to_students(
+    bot: Bot,
+    students: List[Dict[str, Any]],
+    text: Optional[str],
+    file_id: Optional[str] = None,
+    file_type: Optional[str] = None,
+    pin_message: bool = True,
+) -> int:
+    """Параллельная рассылка студентам через _send_and_pin. Возвращает число доставленных сообщений."""
+    prepared = _prepare_outgoing(text, file_id)
+
+    async def send_one(tid: int) -> bool:
+        async with _broadcast_semaphore:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            mid = await _send_and_pin(bot, tid, file_type=file_type, pin_message=pin_message, prepared=prepared)
+            await asyncio.sleep(max(0.0, 1.0 - (loop.time() - started)))
+            return mid is not None
+
+    targets = [st["telegram_id"] for st in students if st.get("telegram_id")]
+    delivered = 0
+    if targets and isinstance(prepared[0], FSInputFile):
+        # файл с диска загружаем первому получателю, остальным уходит уже выданный Telegram file_id
+        delivered += await send_one(targets.pop(0))
+        prepared = _prepare_outgoing(text, file_id)
+
+    results = await asyncio.gather(*(send_one(tid) for tid in targets))
+    return delivered + sum(results)
+
+
+async def _notify_staff(chat_ids: Set[int], send: Callable[[int], Awaitable[Any]], what: str) -> None:
+    """Уведомляет преподавателей/админов параллельно (в пределах общего лимита рассылки)."""
+    async def notify_one(tid: int) -> None:
+        async with _broadcast_semaphore:
+            try:
+                await send(tid)
+            except TelegramAPIError as e:
+                logger.error(f"Notify teacher/admin {tid} about {what} fail: {e}")
+
+    await asyncio.gather(*(notify_one(tid) for tid in chat_ids))
+
+
+def _spawn_background(coro: Awaitable[Any]) -> asyncio.Task:
+    """Запускает задачу в фоне и держит на неё ссылку, пока она не завершится."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _deliver_to_group(
+    bot: Bot,
+    db_pool: asyncpg.Pool,
+    action: str,
+    gid: int,
+    label: str,
+    text: str,
+    file_id: Optional[str],
+    file_type: Optional[str],
+    pin_message: bool,
+):
+    """Рассылка по группе в фоне: очередь не ждёт, пока уйдут все сообщения."""
+    try:
+        async with db_pool.acquire() as conn:
+            students = await api.get_users(conn, role="student", group_id=gid, approved=True)
+        if not students:
+            logger.warning(f"No students for {action} {label} in group {gid}")
+            return
+        sent_count = await _broadcast_to_students(bot, students, text, file_id, file_type, pin_message=pin_message)
+        logger.info(f"Sent {action} {label} to {sent_count}/{len(students)} students in group {gid}.")
+    except Exception as e:
+        logger.error(f"Error delivering {action} {label} to group {gid}: {e}", exc_info=True)
+
+
+def _take_queue_batch(queue_file: str) -> List[Dict[str, Any]]:
+    """
+    Забирает все накопившиеся действия из JSONL-очереди backend'а и обнуляет файл.
+    Под тем же flock, что и писатель в backend, — запись не теряется между чтением и truncate.
+    """
+    try:
+        fd = os.open(queue_file, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    except FileNotFoundError:
+        return []
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        chunks = []
+        while chunk := os.read(fd, 1 << 16):
+            chunks.append(chunk)
+        if chunks:
+            os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)  # закрытие снимает flock
+
+    items = []
+    for line in b"".join(chunks).splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            logger.error(f"Skipping malformed queue line from {queue_file}: {line[:200]!r}")
+    return items
+
+
 async def process_assignment_queue(bot: Bot, db_pool: asyncpg.Pool):
-    queue_file = "/tmp/bot_queue.json"
+    queue_file = BOT_QUEUE_FILE
     while True:
         await asyncio.sleep(2)
-        current_queue = []
-        if os.path.exists(queue_file):
-            try:
-                with open(queue_file, "r+", encoding="utf-8") as f:
-                    try:
-                        content = f.read()
-                        if content:
-                            current_queue = json.loads(content)
-                        else:
-                            current_queue = []
-                        f.seek(0)
-                        f.truncate()
-                        if not isinstance(current_queue, list):
-                            current_queue = []
-                    except json.JSONDecodeError:
-                        logger.error(f"Error decoding JSON from {queue_file}. File cleared.")
-                        f.seek(0)
-                        f.truncate()
-                        current_queue = []
-                    except Exception as read_err:
-                        logger.error(f"Error reading/clearing queue file {queue_file}: {read_err}")
-                        current_queue = []
-            except Exception as outer_err:
-                logger.error(f"Unexpected error accessing queue file {queue_file}: {outer_err}")
-                current_queue = []
+        # почти всегда очередь пуста: дешёвый stat вместо потока + open/flock на каждом тике.
+        # Писатель только дописывает в файл, так что ненулевой размер не пропустит ни одной записи
+        try:
+            if os.stat(queue_file).st_size == 0:
+                continue
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.error(f"Error checking queue file {queue_file}: {e}")
+            continue
+        try:
+            # open/flock/read — блокирующие вызовы (flock ждёт писателя из backend), уводим в поток
+            current_queue = await asyncio.to_thread(_take_queue_batch, queue_file)
+        except Exception as e:
+            logger.error(f"Error reading queue file {queue_file}: {e}")
+            current_queue = []
 
         if not current_queue:
             continue
@@ -1425,44 +1662,24 @@ async def process_assignment_queue(bot: Bot, db_pool: asyncpg.Pool):
                     if not gid or not aid:
                         logger.warning(f"Skipping {action}: missing gid/aid")
                         continue
-                    async with db_pool.acquire() as conn:
-                        students = await api.get_users(conn, role="student", group_id=gid, approved=True)
-                    if not students:
-                        logger.warning(f"No students for {action} {aid} in group {gid}")
-                        continue
                     text = f"🔔 <b>Новое задание: {html.quote(title)}</b>\n📌 ID Задания: {aid}\n\n..."
-                    sent_count = 0
-                    for st in students:
-                        tid = st.get("telegram_id")
-                        if tid:
-                            mid = await _send_and_pin(bot, tid, text=text, file_id=data.get("file_id"), file_type=data.get("file_type"), pin_message=True)
-                            if mid:
-                                sent_count += 1
-                            await asyncio.sleep(0.04)
-                    logger.info(f"Sent {action} {aid} to {sent_count}/{len(students)} students in group {gid}.")
+                    _spawn_background(_deliver_to_group(
+                        bot, db_pool, action, gid, str(aid), text,
+                        data.get("file_id"), data.get("file_type"), pin_message=True,
+                    ))
 
                 elif action == "send_material_to_group":
                     gid, cat, title = data.get("group_id"), data.get("category", "other"), data.get("title", "Материал")
                     if not gid:
                         logger.warning(f"Skipping {action}: missing gid")
                         continue
-                    async with db_pool.acquire() as conn:
-                        students = await api.get_users(conn, role="student", group_id=gid, approved=True)
-                    if not students:
-                        logger.warning(f"No students for {action} '{title}' in group {gid}")
-                        continue
                     body = f"🆕 <b>{html.quote(MATERIAL_CATEGORIES.get(cat, cat.capitalize()))}: {html.quote(title)}</b>\n\n..."
                     files = data.get("files", [])
                     fid, ftype = (files[0]['file_id'], files[0].get('file_type')) if files else (None, None)
-                    sent_count = 0
-                    for st in students:
-                        tid = st.get("telegram_id")
-                        if tid:
-                            mid = await _send_and_pin(bot, tid, text=body, file_id=fid, file_type=ftype, pin_message=data.get("pin", True))
-                            if mid:
-                                sent_count += 1
-                            await asyncio.sleep(0.04)
-                    logger.info(f"Sent {action} '{title}' to {sent_count}/{len(students)} students in group {gid}.")
+                    _spawn_background(_deliver_to_group(
+                        bot, db_pool, action, gid, f"'{title}'", body,
+                        fid, ftype, pin_message=data.get("pin", True),
+                    ))
 
                 elif action == "send_grade_to_student":
                     st_tid = data.get("student_telegram_id")
@@ -1502,9 +1719,8 @@ async def process_assignment_queue(bot: Bot, db_pool: asyncpg.Pool):
                 elif action == "notify_user_approval":
                     st_tid = data.get("student_telegram_id")
                     if st_tid:
-                        builder = InlineKeyboardBuilder()
-                        builder.button(text=data.get("button_text", "Меню"), callback_data="open_menu")
-                        markup = builder.as_markup()
+                        _invalidate_user(st_tid)  # approved поменял backend — следующий апдейт перечитает БД
+                        markup = _approval_markup(data.get("button_text", "Меню"))
                         text = "✅ <b>Ваша регистрация одобрена!</b>\n\nТеперь вам доступно главное меню и функции бота."
                         try:
                             await bot.send_message(st_tid, text, parse_mode=ParseMode.HTML, reply_markup=markup)
@@ -1539,7 +1755,7 @@ async def handle_webapp_data(message: Message, bot: Bot):
         return
     try:
         data_str = message.web_app_data.data
-        data = json.loads(data_str)
+        data = orjson.loads(data_str)
         action = data.get("action")
         logger.info(f"Received WebApp data from {message.from_user.id}: action={action}")
         if action:
@@ -1547,7 +1763,7 @@ async def handle_webapp_data(message: Message, bot: Bot):
         else:
             await message.answer(f"ℹ️ Получены данные из WebApp.")
             logger.info(f"Received unknown WebApp data structure: {data_str}")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error(f"WebApp JSON decode error from {message.from_user.id}: {message.web_app_data.data}")
         await message.answer("❌ Ошибка обработки данных из WebApp (неверный JSON).")
     except Exception as e:
@@ -1594,8 +1810,7 @@ async def main():
 
     try:
         pool = await get_db_pool()
-        async with pool.acquire() as conn:
-            await conn.fetchval("SELECT 1")
+        await pool.fetchval("SELECT 1")
         logger.info("✅ База данных успешно подключена.")
     except Exception as e:
         logger.critical(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к БД: {e}", exc_info=True)
@@ -1643,6 +1858,8 @@ async def main():
         queue_task.cancel()
         with suppress(asyncio.CancelledError):
             await queue_task
+        for task in list(_background_tasks):
+            task.cancel()
         logger.info("Закрытие сессии бота...")
         if bot and bot.session:
             await bot.session.close()
@@ -1657,7 +1874,9 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # как в backend.py: loop_factory через Runner (Python 3.11 в Dockerfile)
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop is not None else None) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logger.info("👋 Бот принудительно остановлен (KeyboardInterrupt).")
     except Exception as e:
@@ -139,22 +139,46 @@ CREATE TABLE IF NOT EXISTS material_links (
 ------------------------------------------------------------
 -- Индексы
 ------------------------------------------------------------
-CREATE INDEX IF NOT EXISTS idx_users_role           ON users(role);
-CREATE INDEX IF NOT EXISTS idx_users_approved       ON users(approved);
+-- фильтры /users?role=...&approved=...: составной индекс покрывает и запросы только по role
+DROP INDEX IF EXISTS idx_users_role;
+CREATE INDEX IF NOT EXISTS idx_users_role_approved  ON users(role, approved);
+-- approved отдельно не нужен: его покрывают idx_users_role_approved и частичный idx_users_unapproved
+DROP INDEX IF EXISTS idx_users_approved;
 CREATE INDEX IF NOT EXISTS idx_students_group_id    ON students(group_id);
-CREATE INDEX IF NOT EXISTS idx_students_pending_gid ON students(pending_group_id);
-CREATE INDEX IF NOT EXISTS idx_assignments_group_id ON assignments(group_id);
-CREATE INDEX IF NOT EXISTS idx_submissions_assign   ON submissions(assignment_id);
+-- pending_* почти всегда NULL — индексируем только реальные заявки
+-- (новое имя: на уже развёрнутых БД IF NOT EXISTS пропустил бы определение под старым именем)
+DROP INDEX IF EXISTS idx_students_pending_gid;
+CREATE INDEX IF NOT EXISTS idx_students_pending_gid_partial ON students(pending_group_id) WHERE pending_group_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_students_pending_at  ON students(group_change_requested_at) WHERE pending_group_id IS NOT NULL;
+-- поиск по group_id покрывает idx_assignments_grp_id_desc (group_id — первая колонка)
+DROP INDEX IF EXISTS idx_assignments_group_id;
+-- сдачи задания в админке идут в порядке submission_date DESC — сортировка берётся из индекса
+-- (поиск только по assignment_id и так покрывает UNIQUE (assignment_id, student_id))
+DROP INDEX IF EXISTS idx_submissions_assign;
+CREATE INDEX IF NOT EXISTS idx_submissions_assign_date ON submissions(assignment_id, submission_date DESC);
+-- «Мои оценки» в боте. Покрывающий INCLUDE-индекс убран: teacher_comment — TEXT без ограничения,
+-- длинный комментарий превышал предельный размер строки btree и ронял UPDATE оценки
+DROP INDEX IF EXISTS idx_submissions_student_cov;
 CREATE INDEX IF NOT EXISTS idx_submissions_student  ON submissions(student_id);
 CREATE INDEX IF NOT EXISTS idx_attendance_grp_date  ON attendance(group_id, attendance_date);
 CREATE INDEX IF NOT EXISTS idx_attendance_stu_date  ON attendance(student_id, attendance_date);
 CREATE INDEX IF NOT EXISTS idx_questions_student_id ON questions(student_id);
 CREATE INDEX IF NOT EXISTS idx_questions_group_id   ON questions(group_id);
 CREATE INDEX IF NOT EXISTS idx_questions_answered_by ON questions(answered_by);
-CREATE INDEX IF NOT EXISTS idx_users_pending_name   ON users(pending_first_name);
+-- заявки на смену имени: частичный индекс под новым именем, старый (по pending_first_name) удаляем
+DROP INDEX IF EXISTS idx_users_pending_name;
+CREATE INDEX IF NOT EXISTS idx_users_pending_name_at ON users(name_change_requested_at) WHERE pending_first_name IS NOT NULL;
+-- очередь неотвеченных вопросов
+CREATE INDEX IF NOT EXISTS idx_questions_unanswered ON questions(asked_at DESC) WHERE answer_text IS NULL;
+-- заявки на одобрение (админка: /users?approved=false) — частичный индекс, только неодобренные
+CREATE INDEX IF NOT EXISTS idx_users_unapproved     ON users(last_name, first_name) WHERE approved = FALSE;
+-- списки заданий группы сортируются по assignment_id DESC
+CREATE INDEX IF NOT EXISTS idx_assignments_grp_id_desc ON assignments(group_id, assignment_id DESC);
 
 -- Материалы
-CREATE INDEX IF NOT EXISTS idx_materials_group_id   ON materials(group_id);
+-- поиск по group_id покрывает idx_materials_grp_id_desc
+DROP INDEX IF EXISTS idx_materials_group_id;
 CREATE INDEX IF NOT EXISTS idx_materials_category   ON materials(category);
+CREATE INDEX IF NOT EXISTS idx_materials_grp_id_desc ON materials(group_id, material_id DESC);
 CREATE INDEX IF NOT EXISTS idx_mfiles_material_id   ON material_files(material_id);
 CREATE INDEX IF NOT EXISTS idx_mlinks_material_id   ON material_links(material_id);